@@ -77,6 +77,9 @@ admin.site.register(Shape, ReadOnlyOSMGeoAdmin)
 admin.site.register(Frequency, ReadOnlyModelAdmin)
 admin.site.register(Transfer, ReadOnlyModelAdmin)
 admin.site.register(UniversalCalendar, ReadOnlyModelAdmin)
+admin.site.register(FeedFile, ReadOnlyModelAdmin)
+admin.site.register(Departure, ReadOnlyModelAdmin)
+admin.site.register(RouteStopPair, ReadOnlyModelAdmin)
 
 if settings.GTFS_SOURCE_MODEL == "gtfs.Source":
     admin.site.register(Source)
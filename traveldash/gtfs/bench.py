@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the GTFS loading code.
+
+    python -m traveldash.gtfs.bench csv FEED [FILENAME]
+    python -m traveldash.gtfs.bench timetable TIMETABLE
+
+FEED is a GTFS zip file or extracted directory, TIMETABLE a file written by
+traveldash.gtfs.timetable.build(). Neither needs a database, but the
+timetable one needs DJANGO_SETTINGS_MODULE set.
+"""
+
+import csv
+import datetime
+import time
+import zipfile
+from itertools import islice
+from optparse import OptionParser
+
+from traveldash.gtfs.utils import CSVReader, UTF8Recoder, ZipFeed, open_feed
+
+
+def timed(func, repeat):
+    """ Best wall-clock time of `repeat` runs of func(), and its last result """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_csv(feed, filename, repeat):
+    """ UTF8Recoder + csv.DictReader vs CSVReader, reading every value of every row """
+    def dict_reader():
+        rows = 0
+        with feed.open(filename) as f:
+            reader = csv.DictReader(UTF8Recoder(f, 'utf-8-sig'))
+            columns = reader.fieldnames
+            for row in reader:
+                for k in columns:
+                    row[k]
+                rows += 1
+        return rows
+
+    def fast_reader():
+        rows = 0
+        with feed.open(filename) as f:
+            reader = CSVReader(f)
+            columns = reader.fieldnames
+            for row in reader:
+                for k in columns:
+                    row[k]
+                rows += 1
+        return rows
+
+    results = []
+    for name, func in (('UTF8Recoder + DictReader', dict_reader), ('CSVReader', fast_reader)):
+        elapsed, rows = timed(func, repeat)
+        results.append(elapsed)
+        print "%-26s %8d rows %8.3fs %10d rows/s" % (name, rows, elapsed, rows / max(elapsed, 1e-6))
+    print "Speedup: %.2fx" % (results[0] / max(results[1], 1e-6))
+
+
+def bench_timetable(path, repeat, queries=1000):
+    """ Opening a timetable vs reading the file in, then next departure queries from a spread of stops """
+    from traveldash.gtfs.timetable import Timetable
+
+    def read():
+        with open(path, 'rb') as f:
+            return len(f.read())
+
+    def open_timetable():
+        return Timetable(path)
+
+    elapsed, size = timed(read, repeat)
+    print "%-26s %8.1fMB %8.3fms" % ('read()', size / 1048576.0, elapsed * 1000)
+    elapsed, tt = timed(open_timetable, repeat)
+    print "%-26s %8.1fMB %8.3fms" % ('Timetable()', size / 1048576.0, elapsed * 1000)
+    print "Source %s, feed %s, built %s" % (tt.source_id, tt.feed_hash, tt.built_at)
+
+    # 8am in the middle of the calendar
+    day = tt.base_date + datetime.timedelta(days=tt.days // 2)
+    start_time = datetime.datetime(day.year, day.month, day.day, 8, 0)
+    step = max(1, len(tt.stop_pk) // queries)
+    stops = [tt.stop_pk[i] for i in range(0, len(tt.stop_pk), step)]
+
+    def query():
+        found = 0
+        for stop_id in stops:
+            found += len(list(islice(tt.departures(stop_id, start_time), 10)))
+        return found
+
+    elapsed, found = timed(query, repeat)
+    print "%-26s %8d stops %8.3fs %10d queries/s (%d departures)" % ('departures()', len(stops), elapsed, len(stops) / max(elapsed, 1e-6), found)
+
+
+def main():
+    parser = OptionParser(usage="%prog csv FEED [FILENAME] | timetable TIMETABLE")
+    parser.add_option("--repeat", action="store", dest="repeat", type="int", default=3, help="Number of runs to take the best of")
+
+    options, args = parser.parse_args()
+    if len(args) < 2 or args[0] not in ('csv', 'timetable'):
+        parser.error("Need a benchmark name & a feed or timetable")
+
+    if args[0] == 'timetable':
+        bench_timetable(args[1], options.repeat)
+        return
+
+    if zipfile.is_zipfile(args[1]):
+        feed = ZipFeed(open(args[1], 'rb'))
+    else:
+        feed = open_feed(args[1])
+
+    bench_csv(feed, args[2] if len(args) > 2 else 'stop_times.txt', options.repeat)
+
+if __name__ == '__main__':
+    main()
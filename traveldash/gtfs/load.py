@@ -1,21 +1,43 @@
 #!/usr/bin/env python
 
-import tempfile
-import shutil
-import zipfile
+import sys
+import Queue
 import logging
+import threading
 from optparse import OptionParser
 
-from django.db import transaction
+from django.db import connections, router, transaction
 
 from traveldash.gtfs.models import *
+from traveldash.gtfs.utils import ZipFeed, open_feed
+from traveldash.gtfs import timetable
 
 L = logging.getLogger("traveldash.gtfs.load")
 
+# the GTFS files, in a valid serial load order. See GTFSModel.GTFS_DEPENDS for
+# what each one needs loaded beforehand.
+GTFS_MODELS = (
+    Agency,
+    Stop,
+    Block,
+    Fare,
+    Shape,
+    Calendar,
+    CalendarDate,
+    Route,
+    Transfer,
+    Trip,
+    StopTime,
+    Frequency,
+    FareRule,
+)
+
 
 def main():
     parser = OptionParser()
     parser.add_option("--source", action="store", dest="source_id", type="int", metavar="SOURCE_ID", help="ID of a Source object to relate the imported data to")
+    parser.add_option("--differential", action="store_true", dest="differential", default=False, help="Only apply changes against the existing data for the source")
+    parser.add_option("--workers", action="store", dest="workers", type="int", default=1, help="Number of files to load concurrently (full loads only)")
 
     options, args = parser.parse_args()
     if not len(args) == 1:
@@ -27,48 +49,222 @@ def main():
         source = None
 
     loader = transaction.commit_on_success(load_zip)
-    loader(args[0], source)
+    loader(args[0], source, options.differential, options.workers)
 
+    # only once it's committed, since web processes start using it straight away
+    if timetable.GTFS_TIMETABLE_DIR:
+        timetable.build(source)
 
-def load_zip(zip_file, source):
-    temp_dir = tempfile.mkdtemp()
-    try:
-        L.info('Extracting %s...', zip_file)
-        zip = zipfile.ZipFile(open(zip_file, 'rb'))
-        zip.extractall(temp_dir)
 
-        load(temp_dir, source)
+def load_zip(zip_file, source, differential=False, workers=1):
+    L.info('Reading %s...', zip_file)
+    feed = ZipFeed(open(zip_file, 'rb'))
+    try:
+        load(feed, source, differential, workers)
     finally:
-        shutil.rmtree(temp_dir)
+        feed.close()
+
+
+def load_order():
+    """
+    Order GTFS_MODELS so each comes after the models it depends on. Raises
+    ValueError if the dependencies are circular.
+    """
+    names = dict([(m.__name__, m) for m in GTFS_MODELS])
+    order = []
+    visiting = set()
+
+    def visit(model_class):
+        if model_class in order:
+            return
+        if model_class in visiting:
+            raise ValueError("Circular GTFS_DEPENDS involving %s" % model_class.__name__)
+        visiting.add(model_class)
+        for name in model_class.GTFS_DEPENDS:
+            visit(names[name])
+        visiting.remove(model_class)
+        order.append(model_class)
 
+    for model_class in GTFS_MODELS:
+        visit(model_class)
+    return order
 
-def load(temp_dir, source):
+
+def load(feed, source, differential=False, workers=1):
     # load GTFS data files & transform/derive additional data
     # due to foreign key constraints these files need to be loaded in the appropriate order
+    feed = open_feed(feed)
+    if differential and not supports_copy(router.db_for_write(Agency)):
+        raise ValueError("Differential loads need PostgreSQL; do a full load instead")
 
-    # these two are pseudo-models which are created during the load process
-    # of other classes. We delete the records upfront.
-    Zone.objects.filter(source=source).delete()
-    Service.objects.filter(source=source).delete()
+    # derived from everything else, and far quicker to rebuild than to have
+    # the ORM cascade deletes through
+    Departure.gtfs_clear(source)
+    RouteStopPair.gtfs_clear(source)
 
-    Agency.gtfs_load(source, temp_dir)
+    if workers > 1:
+        if differential:
+            raise ValueError("Parallel loads can't be differential")
+        load_parallel(feed, source, workers)
+        UniversalCalendar.gtfs_rebuild(source)
+        Departure.gtfs_rebuild(source)
+        RouteStopPair.gtfs_rebuild(source)
+        return
 
-    Stop.gtfs_load(source, temp_dir)
-    Block.gtfs_load(source, temp_dir)
-    Fare.gtfs_load(source, temp_dir)
-    Shape.gtfs_load(source, temp_dir)
+    if not differential:
+        # these two are pseudo-models which are created during the load process
+        # of other classes. We delete the records upfront.
+        Zone.objects.filter(source=source).delete()
+        Service.objects.filter(source=source).delete()
+        FeedFile.objects.filter(source=source).delete()
 
-    Calendar.gtfs_load(source, temp_dir)
-    CalendarDate.gtfs_load(source, temp_dir)
-    Route.gtfs_load(source, temp_dir)
-    Transfer.gtfs_load(source, temp_dir)
-    Trip.gtfs_load(source, temp_dir)
-    StopTime.gtfs_load(source, temp_dir)
-    Frequency.gtfs_load(source, temp_dir)
-    FareRule.gtfs_load(source, temp_dir)
+    for model_class in load_order():
+        model_class.gtfs_load(source, feed, differential=differential)
+
+    if differential:
+        # pseudo-models nothing refers to any more
+        Zone.objects.filter(source=source, stops__isnull=True, fare_rule_origins__isnull=True,
+                            fare_rule_destinations__isnull=True, fare_rule_contains__isnull=True).delete()
+        Service.objects.filter(source=source, calendar__isnull=True, calendar_exceptions__isnull=True,
+                               trips__isnull=True).delete()
 
     # Calculated/Derived stuff
     UniversalCalendar.gtfs_rebuild(source)
+    Departure.gtfs_rebuild(source)
+    RouteStopPair.gtfs_rebuild(source)
+
+
+def load_parallel(feed, source, workers):
+    """
+    Full load of a feed, running up to `workers` files at once as soon as the
+    files they depend on are done.
+
+    Each worker thread has its own database connection & transaction, so the
+    files are loaded into unlogged staging tables rather than the real ones.
+    The staging tables are then copied over in the caller's transaction, so
+    the existing data is only replaced once everything has loaded. They're
+    written with COPY, so this needs PostgreSQL.
+    """
+    using = router.db_for_write(Agency)
+    if not supports_copy(using):
+        raise ValueError("Parallel loads need PostgreSQL, but the '%s' database is %s; load with one worker instead" % (using, connections[using].settings_dict['ENGINE']))
+
+    feed = open_feed(feed)
+    order = load_order()
+    staged = [Zone, Service] + order
+    stage_tables = dict([(m, "%s_stage_%s" % (m._meta.db_table, getattr(source, 'pk', 0))) for m in staged])
+
+    _in_thread(_create_stage_tables, staged, stage_tables)
+    try:
+        _run_workers(order, source, feed, workers, stage_tables)
+    except:
+        exc_info = sys.exc_info()
+        _in_thread(_drop_stage_tables, staged, stage_tables)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    _swap_stage_tables(staged, stage_tables, source, feed)
+
+
+def _run_workers(order, source, feed, workers, stage_tables):
+    finished = Queue.Queue()
+    remaining = list(order)
+    running = {}
+    done = set()
+    error = None
+
+    while remaining or running:
+        for model_class in list(remaining):
+            if error or len(running) >= workers:
+                break
+            if set(model_class.GTFS_DEPENDS) <= done:
+                remaining.remove(model_class)
+                running[model_class] = threading.Thread(target=_load_staged, args=(finished, model_class, source, feed, stage_tables))
+                running[model_class].start()
+
+        if not running:
+            break
+
+        model_class, exc_info = finished.get()
+        running.pop(model_class).join()
+        if exc_info:
+            L.error("Loading %s failed", model_class.gtfs_filename(), exc_info=exc_info)
+            error = error or exc_info
+        else:
+            done.add(model_class.__name__)
+
+    if error:
+        raise error[0], error[1], error[2]
+
+
+def _load_staged(finished, model_class, source, feed, stage_tables):
+    using = router.db_for_write(model_class)
+    feed = feed.clone()
+    try:
+        transaction.commit_on_success(using=using)(model_class.gtfs_load)(source, feed, stage_tables=stage_tables)
+    except:
+        finished.put((model_class, sys.exc_info()))
+    else:
+        finished.put((model_class, None))
+    finally:
+        feed.close()
+        connections[using].close()
+
+
+def _in_thread(func, *args):
+    """ Run func in its own thread, so it uses (& commits) a separate connection """
+    result = []
+
+    def run():
+        try:
+            transaction.commit_on_success(func)(*args)
+        except:
+            result.append(sys.exc_info())
+        finally:
+            connections[router.db_for_write(Agency)].close()
+
+    t = threading.Thread(target=run)
+    t.start()
+    t.join()
+    if result:
+        raise result[0][0], result[0][1], result[0][2]
+
+
+def _create_stage_tables(staged, stage_tables):
+    # LIKE ... INCLUDING DEFAULTS shares the real tables' id sequences, so the
+    # ids assigned while staging can be copied over as-is.
+    cursor = connections[router.db_for_write(Agency)].cursor()
+    for model_class in staged:
+        qn = connections[router.db_for_write(model_class)].ops.quote_name
+        cursor.execute("DROP TABLE IF EXISTS %s" % qn(stage_tables[model_class]))
+        cursor.execute("CREATE UNLOGGED TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (qn(stage_tables[model_class]), qn(model_class._meta.db_table)))
+
+
+def _drop_stage_tables(staged, stage_tables):
+    cursor = connections[router.db_for_write(Agency)].cursor()
+    for model_class in staged:
+        qn = connections[router.db_for_write(model_class)].ops.quote_name
+        cursor.execute("DROP TABLE IF EXISTS %s" % qn(stage_tables[model_class]))
+
+
+def _swap_stage_tables(staged, stage_tables, source, feed):
+    L.info("Replacing existing data with the staged tables...")
+    Zone.objects.filter(source=source).delete()
+    Service.objects.filter(source=source).delete()
+    FeedFile.objects.filter(source=source).delete()
+    for model_class in reversed(staged):
+        if issubclass(model_class, GTFSModel):
+            model_class.gtfs_truncate(source)
+
+    cursor = connections[router.db_for_write(Agency)].cursor()
+    for model_class in staged:
+        qn = connections[router.db_for_write(model_class)].ops.quote_name
+        cursor.execute("INSERT INTO %s SELECT * FROM %s" % (qn(model_class._meta.db_table), qn(stage_tables[model_class])))
+        cursor.execute("DROP TABLE %s" % qn(stage_tables[model_class]))
+    transaction.commit_unless_managed(using=router.db_for_write(Agency))
+
+    for model_class in staged:
+        if issubclass(model_class, GTFSModel) and feed.exists(model_class.gtfs_filename()):
+            filename = model_class.gtfs_filename()
+            FeedFile.objects.create(source=source, filename=filename, fingerprint=feed.fingerprint(filename))
 
 if __name__ == '__main__':
     main()
@@ -1,62 +1,473 @@
 import time
-import os
 import csv
 import re
+import codecs
 import datetime
 import logging
+import traceback
+import multiprocessing
+from cStringIO import StringIO
 
 from django.contrib.gis.db import models
+from django.contrib.gis.db.models.fields import GeometryField
 from django.contrib.gis import geos
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models.loading import get_model
+from django.db import connections, router, transaction
 from django.db.models import Min, Max
 
-from .utils import UTF8Recoder
+from .utils import CSVReader, UTF8Recoder, copy_line, open_feed, read_chunks
+
+# Number of rows to accumulate before writing them to the database in one go.
+# Set to 1 to save each row individually.
+GTFS_LOAD_BATCH_SIZE = getattr(settings, 'GTFS_LOAD_BATCH_SIZE', 10000)
+
+# Number of worker processes to parse the big files (see GTFS_PARALLEL_PARSE)
+# with. 1 parses them in-process like everything else.
+GTFS_PARSE_PROCESSES = getattr(settings, 'GTFS_PARSE_PROCESSES', 1)
+
+# Whether to read files with the faster utils.CSVReader rather than
+# csv.DictReader. Feeds need to be UTF-8.
+GTFS_FAST_CSV = getattr(settings, 'GTFS_FAST_CSV', False)
+
+# Number of days ahead of today to build Departures for
+GTFS_DEPARTURE_DAYS = getattr(settings, 'GTFS_DEPARTURE_DAYS', 2)
+
+# Approximate size in bytes of the blocks handed to each parse process
+GTFS_PARSE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# (model, source, fieldnames, plan) for the parse processes, which inherit it
+# when they're forked.
+_parse_context = None
+
+
+class GTFSColumnPlan(object):
+    """
+    How the columns of a GTFS file map onto a model: a list of
+    (column, attribute, converter) tuples, plus the columns that only
+    gtfs_populate() can deal with.
+    """
+    def __init__(self, has_source=False):
+        self.has_source = has_source
+        self.columns = []
+        self.unmatched = set()
+        # columns consumed by gtfs_populate(), known after the first row
+        self.populated = None
+
+    def add(self, column, attname, converter=None):
+        self.columns.append((column, attname, converter))
+
+    def matched(self):
+        return set([c[0] for c in self.columns])
 
 
 class GTFSModel(object):
     """ Loading behaviour for GTFS files """
 
+    # Field attnames which identify a record within a source, for differential
+    # loads. Models without one are always truncated & reloaded.
+    GTFS_KEY = None
+
+    # Names of the GTFSModels which need to be loaded before this one, because
+    # it refers to them (or creates the same pseudo-model records).
+    GTFS_DEPENDS = ()
+
+    # Whether full loads can parse the file in separate processes. Only for
+    # models which don't create other records while parsing (eg. Zones).
+    GTFS_PARALLEL_PARSE = False
+
     @classmethod
-    def gtfs_load(cls, source, directory):
+    def gtfs_load(cls, source, feed, batch_size=None, differential=False, processes=None, fast_csv=None, stage_tables=None):
+        """
+        Load the model's GTFS file from feed, which is a directory path or a
+        utils.ZipFeed/DirectoryFeed. In differential mode an
+        unchanged file (as per its last recorded fingerprint) is skipped
+        entirely, and otherwise only the changes are applied against the
+        existing records (see gtfs_sync()).
+
+        stage_tables maps model classes to the staging tables they're being
+        loaded into by load.load_parallel(), for this file's rows and the
+        records it refers to.
+        """
         L = logging.getLogger('traveldash.gtfs.%s.gtfs_load' % cls.__name__)
 
-        L.info("Beginning load of %s", cls.gtfs_filename())
-        file_path = os.path.join(directory, cls.gtfs_filename())
-        if not os.path.exists(file_path):
-            L.info("%s not found... skipping", cls.gtfs_filename())
-        else:
-            cls._gtfs_relation_cache = {}
-            try:
-                start_time = time.time()
-                with open(file_path, 'r') as f:
+        if batch_size is None:
+            batch_size = GTFS_LOAD_BATCH_SIZE
+        if processes is None:
+            processes = GTFS_PARSE_PROCESSES
+        if fast_csv is None:
+            fast_csv = GTFS_FAST_CSV
+
+        feed = open_feed(feed)
+        filename = cls.gtfs_filename()
+        L.info("Beginning load of %s", filename)
+        if not feed.exists(filename):
+            if differential and FeedFile.objects.filter(source=source, filename=filename).exists():
+                L.info("%s has been removed from the feed... deleting existing records", filename)
+                cls.gtfs_truncate(source)
+                FeedFile.objects.filter(source=source, filename=filename).delete()
+            else:
+                L.info("%s not found... skipping", filename)
+            return
+
+        fingerprint = feed.fingerprint(filename)
+        if differential and FeedFile.objects.filter(source=source, filename=filename, fingerprint=fingerprint).exists():
+            L.info("%s is unchanged... skipping", filename)
+            return
+
+        table = (stage_tables or {}).get(cls)
+        cls._gtfs_relation_cache = {}
+        cls._gtfs_stage_tables = stage_tables or {}
+        try:
+            start_time = time.time()
+            with feed.open(filename) as f:
+                if fast_csv:
+                    reader = CSVReader(f)
+                else:
                     utf8_file = UTF8Recoder(f, 'utf-8-sig')
                     reader = csv.DictReader(utf8_file)
 
-                    cls.gtfs_truncate(source)
+                if differential and cls.GTFS_KEY:
+                    stats = cls.gtfs_sync(source, cls.gtfs_generate(source, reader), batch_size)
+                    L.info("%(inserted)s inserted, %(updated)s updated, %(deleted)s deleted, %(unchanged)s unchanged", stats)
+                    count = sum(stats.values())
+                else:
+                    if not table:
+                        cls.gtfs_truncate(source)
+                    if processes > 1 and cls.GTFS_PARALLEL_PARSE:
+                        count = cls.gtfs_insert_parallel(source, f, processes, table)
+                    else:
+                        count = cls.gtfs_insert(cls.gtfs_generate(source, reader), batch_size, table)
+
+            if not table:
+                # staged loads record these when the tables are swapped in
+                FeedFile.objects.filter(source=source, filename=filename).delete()
+                FeedFile.objects.create(source=source, filename=filename, fingerprint=fingerprint)
+
+            processing_time = time.time() - start_time
+            L.info("%s records, %s seconds", count, int(processing_time))
+        finally:
+            del cls._gtfs_relation_cache
+            del cls._gtfs_stage_tables
+
+    @classmethod
+    def gtfs_insert(cls, objects, batch_size, table=None):
+        """
+        Save an iterable of new instances, batch_size at a time, into the
+        model's table or the staging table if one's given. Returns how many
+        were saved.
+        """
+        L = logging.getLogger('traveldash.gtfs.%s.gtfs_load' % cls.__name__)
+
+        count = 0
+        batch = []
+        batch_num = 0
+        for o in objects:
+            count += 1
+            if batch_size > 1:
+                batch.append(o)
+                if len(batch) >= batch_size:
+                    batch_num += 1
+                    cls.gtfs_save_batch(batch, batch_num, count - len(batch) + 1, table)
+                    batch = []
+            else:
+                try:
+                    if table:
+                        cls.gtfs_bulk_insert([o], router.db_for_write(cls), table)
+                    else:
+                        o.save()
+                except:
+                    L.error("Error processing row %d: %s", count, o.__dict__, exc_info=True)
+                    raise
+
+        if batch:
+            cls.gtfs_save_batch(batch, batch_num + 1, count - len(batch) + 1, table)
+        return count
+
+    @classmethod
+    def gtfs_insert_parallel(cls, source, f, processes, table=None):
+        """
+        Parse a file in a pool of worker processes & save the results. The file
+        is split into blocks on line boundaries, which the workers turn into
+        COPY data; the blocks are written in file order as they come back.
+        Returns how many rows were saved.
+
+        The reference maps are preloaded before the workers are forked, so
+        they share them rather than each querying the database. Fields
+        containing quoted line breaks aren't supported.
+        """
+        global _parse_context
+        L = logging.getLogger('traveldash.gtfs.%s.gtfs_load' % cls.__name__)
+
+        header = f.readline()
+        if header.startswith(codecs.BOM_UTF8):
+            header = header[len(codecs.BOM_UTF8):]
+        fieldnames = csv.reader([header]).next()
+        plan = cls.gtfs_column_plan(source, fieldnames)
+
+        _parse_context = (cls, source, fieldnames, plan)
+        pool = multiprocessing.Pool(processes)
+        try:
+            count = 0
+            for batch_num, (data, rows, error) in enumerate(pool.imap(_parse_chunk, read_chunks(f, GTFS_PARSE_CHUNK_SIZE)), 1):
+                if error:
+                    # rows is how many parsed before the bad one
+                    row, tb = error
+                    L.error("Error processing batch %d, row %d: %s\n%s", batch_num, count + rows + 1, row, tb)
+                    raise ValueError("%s: Error processing batch %d, row %d" % (cls.__name__, batch_num, count + rows + 1))
+                cls.gtfs_save_copy_batch(data, batch_num, count + 1, count + rows, table)
+                count += rows
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _parse_context = None
+        return count
+
+    @classmethod
+    def gtfs_save_copy_batch(cls, data, batch_num, first_row, last_row, table=None):
+        """ Write a batch of COPY data generated by the parse processes """
+        L = logging.getLogger('traveldash.gtfs.%s.gtfs_load' % cls.__name__)
+
+        using = router.db_for_write(cls)
+        sid = transaction.savepoint(using=using)
+        try:
+            cls.gtfs_copy(data, using, table)
+        except Exception:
+            transaction.savepoint_rollback(sid, using=using)
+            L.error("Error loading batch %d (rows %d-%d)", batch_num, first_row, last_row, exc_info=True)
+            raise
+        else:
+            transaction.savepoint_commit(sid, using=using)
+
+    @classmethod
+    def gtfs_sync(cls, source, objects, batch_size):
+        """
+        Apply the differences between an iterable of instances and the existing
+        records for source. The instances are COPYed into a temporary table and
+        matched up with the existing records on GTFS_KEY in SQL, comparing a
+        hash of their other columns: unchanged records are left alone, changed
+        ones are updated in place (keeping their primary keys), new ones are
+        inserted and ones which have gone away are deleted. Rows with the same
+        key are paired off one for one, so exact duplicates (eg. in
+        fare_rules.txt) don't pile up.
+
+        Neither memory use nor the number of queries grows with the size of the
+        file, only with the number of deletions, which go through the ORM so
+        they cascade (eg. a removed trip's stop times).
+        Returns a dict of counts.
+        """
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fields = [f for f in cls._meta.local_fields if not isinstance(f, models.AutoField)]
+        key_columns = [qn(f.column) for f in fields if f.attname in cls.GTFS_KEY]
+        other_columns = [qn(f.column) for f in fields if f.attname not in cls.GTFS_KEY]
+
+        existing = cls._default_manager.filter(**source_query(cls, source)).values('pk')
+        existing_sql, existing_params = existing.query.get_compiler(using=using).as_sql()
+
+        fmt = {
+            'table': qn(cls._meta.db_table),
+            'pk': qn(cls._meta.pk.column),
+            'incoming': qn('%s_incoming' % cls._meta.db_table),
+            'matches': qn('%s_matches' % cls._meta.db_table),
+            'columns': ", ".join([qn(f.column) for f in fields]),
+            'incoming_columns': ", ".join(["i.%s" % qn(f.column) for f in fields]),
+            'set_columns': ", ".join(["%s = i.%s" % (c, c) for c in other_columns]),
+            'keys': ", ".join(key_columns),
+            # the text form of a row tells NULL & '' apart, and has geometries as hex EWKB
+            'hash': "md5(ROW(%s)::text)" % ", ".join(other_columns) if other_columns else "''::text",
+            'existing': existing_sql,
+        }
+
+        cursor = connection.cursor()
+        cursor.execute("CREATE TEMPORARY TABLE %(incoming)s AS SELECT %(columns)s FROM %(table)s WITH NO DATA" % fmt)
+        cursor.execute("ALTER TABLE %(incoming)s ADD COLUMN gtfs_row serial" % fmt)
+        count = cls.gtfs_insert(objects, batch_size, '%s_incoming' % cls._meta.db_table)
+        cursor.execute("ANALYZE %(incoming)s" % fmt)
+
+        # number the rows sharing each key on both sides, and pair them off
+        cursor.execute("""
+            CREATE TEMPORARY TABLE %(matches)s AS
+            SELECT max(id) AS id, max(gtfs_row) AS gtfs_row, min(gtfs_hash) <> max(gtfs_hash) AS changed
+            FROM (
+                SELECT %(pk)s AS id, NULL::integer AS gtfs_row, %(keys)s, %(hash)s AS gtfs_hash,
+                    row_number() OVER (PARTITION BY %(keys)s ORDER BY %(hash)s, %(pk)s) AS gtfs_n
+                FROM %(table)s
+                WHERE %(pk)s IN (%(existing)s)
+                UNION ALL
+                SELECT NULL, gtfs_row, %(keys)s, %(hash)s,
+                    row_number() OVER (PARTITION BY %(keys)s ORDER BY %(hash)s, gtfs_row)
+                FROM %(incoming)s
+            ) AS u
+            GROUP BY %(keys)s, gtfs_n
+        """ % fmt, existing_params)
+
+        stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+        # whatever's only in the database wasn't in the file
+        cursor.execute("SELECT id FROM %(matches)s WHERE gtfs_row IS NULL" % fmt)
+        pk_list = [row[0] for row in cursor.fetchall()]
+        for i in range(0, len(pk_list), 1000):
+            cls._default_manager.filter(pk__in=pk_list[i:i + 1000]).delete()
+        stats['deleted'] = len(pk_list)
+
+        if other_columns:
+            cursor.execute("""
+                UPDATE %(table)s SET %(set_columns)s
+                FROM %(matches)s AS m JOIN %(incoming)s AS i ON i.gtfs_row = m.gtfs_row
+                WHERE %(table)s.%(pk)s = m.id AND m.changed
+            """ % fmt)
+            stats['updated'] = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO %(table)s (%(columns)s)
+            SELECT %(incoming_columns)s
+            FROM %(incoming)s AS i JOIN %(matches)s AS m ON m.gtfs_row = i.gtfs_row
+            WHERE m.id IS NULL
+            ORDER BY i.gtfs_row
+        """ % fmt)
+        stats['inserted'] = cursor.rowcount
+        stats['unchanged'] = count - stats['inserted'] - stats['updated']
+
+        cursor.execute("DROP TABLE %(incoming)s, %(matches)s" % fmt)
+        transaction.set_dirty(using=using)
+        return stats
+
+    @classmethod
+    def gtfs_get_or_create_ref(cls, model_class, source, **kwargs):
+        """
+        Return the PK of a pseudo-model record (eg. Service, Zone) referenced from
+        a CSV row, creating it if necessary.
+        """
+        cache_key = (model_class, tuple(kwargs.items()))
+        pk = cls._gtfs_relation_cache.get(cache_key)
+        if pk is None:
+            table = cls._gtfs_stage_tables.get(model_class)
+            if table:
+                pk = cls._gtfs_staged_get_or_create(model_class, table, source, kwargs)
+            else:
+                pk = model_class.objects.get_or_create(source=source, **kwargs)[0].pk
+            cls._gtfs_relation_cache[cache_key] = pk
+        return pk
+
+    @classmethod
+    def _gtfs_staged_get_or_create(cls, model_class, table, source, kwargs):
+        connection = connections[router.db_for_write(model_class)]
+        qn = connection.ops.quote_name
+        columns = [model_class._meta.get_field(k).column for k in kwargs]
+        values = kwargs.values()
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s FROM %s WHERE %s" % (
+            qn(model_class._meta.pk.column),
+            qn(table),
+            " AND ".join(["%s = %%s" % qn(c) for c in columns])
+        ), values)
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO %s (%s) VALUES (%s) RETURNING %s" % (
+                qn(table),
+                ", ".join([qn(c) for c in ['source_id'] + columns]),
+                ", ".join(['%s'] * (len(columns) + 1)),
+                qn(model_class._meta.pk.column),
+            ), [getattr(source, 'pk', None)] + values)
+            row = cursor.fetchone()
+            transaction.commit_unless_managed(using=connection.alias)
+        return row[0]
 
-                    for i, o in enumerate(cls.gtfs_generate(source, reader)):
-                        try:
-                            o.save()
-                        except:
-                            L.error("Error processing row: %s", o.__dict__, exc_info=True)
-                            raise
+    @classmethod
+    def gtfs_save_batch(cls, objects, batch_num, first_row, table=None):
+        """
+        Write a batch of new instances to the database. If the bulk write fails,
+        the batch is retried one row at a time so the offending row gets logged.
+        first_row is the (1-based) row number of objects[0] within the file.
+        """
+        L = logging.getLogger('traveldash.gtfs.%s.gtfs_load' % cls.__name__)
 
-                processing_time = time.time() - start_time
-                L.info("%s records, %s seconds", i + 1, int(processing_time))
-            finally:
-                del cls._gtfs_relation_cache
+        using = router.db_for_write(cls)
+        sid = transaction.savepoint(using=using)
+        try:
+            cls.gtfs_bulk_insert(objects, using, table)
+        except Exception:
+            transaction.savepoint_rollback(sid, using=using)
+            L.warning("Error loading batch %d (rows %d-%d), retrying row-by-row", batch_num, first_row, first_row + len(objects) - 1, exc_info=True)
+            for i, o in enumerate(objects):
+                try:
+                    if table:
+                        cls.gtfs_bulk_insert([o], using, table)
+                    else:
+                        o.save(using=using)
+                except:
+                    L.error("Error processing batch %d, row %d: %s", batch_num, first_row + i, o.__dict__, exc_info=True)
+                    raise
+        else:
+            transaction.savepoint_commit(sid, using=using)
+
+    @classmethod
+    def gtfs_bulk_insert(cls, objects, using, table=None):
+        """
+        Insert new instances in bulk. On PostgreSQL the rows are streamed in via
+        COPY ... FROM STDIN (into table, if given), otherwise we use
+        bulk_create() where it's available. Primary keys are not set on the
+        instances afterwards, and save signals aren't sent.
+        """
+        connection = connections[using]
+        if table or supports_copy(using):
+            # staged loads are PostgreSQL-only, see load.load_parallel()
+            cls.gtfs_copy("".join(cls.gtfs_copy_lines(objects, connection)), using, table)
+        elif hasattr(cls._default_manager, 'bulk_create'):
+            cls._default_manager.db_manager(using).bulk_create(objects)
+        else:
+            for o in objects:
+                o.save(using=using)
+
+    @classmethod
+    def gtfs_copy_lines(cls, objects, connection):
+        """ Format instances as a list of PostgreSQL COPY text lines """
+        fields = [f for f in cls._meta.local_fields if not isinstance(f, models.AutoField)]
+
+        data = []
+        for o in objects:
+            values = []
+            for f in fields:
+                if isinstance(f, GeometryField):
+                    # COPY wants the text form, which for PostGIS is hex EWKB
+                    geom = getattr(o, f.attname)
+                    if geom is not None:
+                        if geom.srid is None:
+                            geom.srid = f.srid
+                        geom = geom.hexewkb
+                    values.append(geom)
+                else:
+                    values.append(f.get_db_prep_save(f.pre_save(o, True), connection=connection))
+            data.append(copy_line(values))
+        return data
+
+    @classmethod
+    def gtfs_copy(cls, data, using, table=None):
+        """
+        COPY a string of text-format rows (see gtfs_copy_lines()) into the
+        model's table, or table if given. The caller commits; this needs to be
+        run under transaction management.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fields = [f for f in cls._meta.local_fields if not isinstance(f, models.AutoField)]
+
+        table = table or cls._meta.db_table
+        sql = "COPY %s (%s) FROM STDIN" % (qn(table), ", ".join([qn(f.column) for f in fields]))
+        connection.cursor().copy_expert(sql, StringIO(data))
+        # raw cursor writes don't mark the transaction dirty by themselves
+        transaction.set_dirty(using=using)
 
     @classmethod
     def gtfs_truncate(cls, source):
         # truncate existing records
-        if 'source' in cls._meta.get_all_field_names():
-            cls.objects.filter(source=source).delete()
-        else:
-            # deletes from the above will cascade, but if we delete these
-            # then we're affecting >1 source
-            pass
+        cls.objects.filter(**source_query(cls, source)).delete()
 
     @classmethod
     def gtfs_filename(cls):
@@ -72,60 +483,102 @@ class GTFSModel(object):
 
     @classmethod
     def gtfs_generate(cls, source, reader):
+        plan = cls.gtfs_column_plan(source, reader.fieldnames or ())
         for row in reader:
-            yield cls.gtfs_instantiate(source, row)
+            yield cls.gtfs_instantiate(source, row, plan)
 
     @classmethod
-    def gtfs_instantiate(cls, source, row):
-        o = cls()
-
-        if 'source' in cls._meta.get_all_field_names():
-            setattr(o, 'source', source)
+    def gtfs_column_plan(cls, source, columns):
+        """
+        Work out how each CSV column maps onto the model once per file, rather
+        than redoing the field introspection for every row.
+        """
+        field_names = set(cls._meta.get_all_field_names())
+        prefix = cls.__name__.lower() + "_"
+        plan = GTFSColumnPlan(has_source=('source' in field_names))
 
-        matched = []
-        errors = []
-        for k, v in row.items():
-            if isinstance(v, basestring):
-                v = v.strip()
+        for k in columns:
             if k.endswith('date'):
-                v = datetime.datetime.strptime(v, '%Y%m%d').date()
+                parse = lambda v: datetime.datetime.strptime(v, '%Y%m%d').date()
+            else:
+                parse = None
 
-            if k in cls._meta.get_all_field_names():
+            if k in field_names:
                 # normal field
-                try:
-                    if isinstance(cls._meta.get_field_by_name(k)[0], models.BooleanField):
-                        # '0' ends up as True...
-                        v = int(v)
-
-                    setattr(o, k, v)
-                except ValueError, e:
-                    # will leave it to be sorted by gtfs_populate()
-                    errors.append(e)
+                if isinstance(cls._meta.get_field_by_name(k)[0], models.BooleanField):
+                    # '0' ends up as True...
+                    convert = int
                 else:
-                    matched.append(k)
+                    convert = parse
+                plan.add(k, k, convert)
             elif k.endswith('_id'):
                 # FK reference
                 kk = k.rsplit('_', 1)[0]
-                if v and (kk in cls._meta.get_all_field_names()):
-                    try:
-                        setattr(o, k, cls.gtfs_lookup_ref(k, kk, v, source))
-                    except (ValueError, ObjectDoesNotExist), e:
-                        # will leave it to be sorted by gtfs_populate()
-                        errors.append(e)
-                    else:
-                        matched.append(k)
-            elif k.startswith(cls.__name__.lower() + "_"):
+                if kk in field_names:
+                    cls.gtfs_preload_refs(k, kk, source)
+                    plan.add(k, k, cls._gtfs_ref_converter(k, kk, source))
+                else:
+                    plan.unmatched.add(k)
+            elif k.startswith(prefix) and k.split('_', 1)[1] in field_names:
                 # dumb prefix
                 kk = k.split('_', 1)[1]
-                if kk in cls._meta.get_all_field_names():
-                    setattr(o, kk, v or cls._meta.get_field_by_name(kk)[0].default)
-                    matched.append(k)
+                default = cls._meta.get_field_by_name(kk)[0].default
+                if parse:
+                    convert = lambda v, parse=parse, default=default: parse(v) if v else default
+                else:
+                    convert = lambda v, default=default: v or default
+                plan.add(k, kk, convert)
+            else:
+                plan.unmatched.add(k)
+
+        return plan
+
+    @classmethod
+    def _gtfs_ref_converter(cls, reference, model_name, source):
+        def convert(v):
+            if not v:
+                raise ValueError("%s: no value for %s" % (cls.__name__, reference))
+            return cls.gtfs_lookup_ref(reference, model_name, v, source)
+        return convert
+
+    @classmethod
+    def gtfs_instantiate(cls, source, row, plan=None):
+        if plan is None:
+            plan = cls.gtfs_column_plan(source, row.keys())
 
-        matched += cls.gtfs_populate(o, row, source)
+        o = cls()
 
-        unmatched = set(row.keys()).difference(set(matched))
-        if len(unmatched):
-            raise ValueError("%s: Found unmatched CSV columns: %s (matched %s) (errors=%s)" % (cls.__name__, ', '.join(unmatched), ', '.join(set(matched)), errors))
+        if plan.has_source:
+            o.source = source
+
+        failed = []
+        errors = []
+        for k, attname, convert in plan.columns:
+            v = row[k]
+            if isinstance(v, basestring):
+                v = v.strip()
+            try:
+                if convert is not None:
+                    v = convert(v)
+                setattr(o, attname, v)
+            except (ValueError, ObjectDoesNotExist), e:
+                # will leave it to be sorted by gtfs_populate()
+                failed.append(k)
+                errors.append(e)
+
+        populated = cls.gtfs_populate(o, row, source)
+
+        if plan.populated is None:
+            # first row: check the header for columns nobody knows about
+            plan.populated = frozenset(populated)
+            unmatched = plan.unmatched.difference(plan.populated)
+            if unmatched:
+                raise ValueError("%s: Found unmatched CSV columns: %s (matched %s)" % (cls.__name__, ', '.join(unmatched), ', '.join(plan.matched().union(plan.populated))))
+
+        if failed:
+            unmatched = [k for k in failed if k not in plan.populated]
+            if unmatched:
+                raise ValueError("%s: Found unmatched CSV columns: %s (errors=%s)" % (cls.__name__, ', '.join(unmatched), errors))
 
         return o
 
@@ -160,18 +613,84 @@ class GTFSModel(object):
         value: value of reference field on the relation (eg. STOP123ZZ)
         source: source dataset instance
         """
-        cache_key = (reference, source, value)
-        pk = cls._gtfs_relation_cache.get(cache_key)
-        if pk is None:
-            model_class = get_model('gtfs', model_name)
-            query = {reference: value}
-            if 'source' in cls._meta.get_all_field_names():
-                query['source'] = source
+        refs = cls._gtfs_relation_cache.get(reference)
+        if refs is None:
+            refs = cls.gtfs_preload_refs(reference, model_name, source)
 
-            pk = model_class.objects.get(**query).pk
-            cls._gtfs_relation_cache[cache_key] = pk
+        pk = refs.get(value)
+        if pk is None:
+            raise ObjectDoesNotExist("%s: Can't find %s with %s=%s" % (cls.__name__, model_name, reference, repr(value)))
         return pk
 
+    @classmethod
+    def gtfs_preload_refs(cls, reference, model_name, source):
+        """
+        Fetch the whole reference -> PK map for a relation in one query, so
+        gtfs_lookup_ref() doesn't need to go to the database per value.
+        Keys are interned UTF-8 bytestrings to match what the CSV reader gives us.
+        """
+        L = logging.getLogger('traveldash.gtfs.%s.gtfs_load' % cls.__name__)
+
+        model_class = cls._meta.get_field_by_name(model_name)[0].rel.to
+        if reference in model_class._meta.get_all_field_names():
+            key_field = reference
+        else:
+            # eg. parent_station_id -> stop_id
+            key_field = '%s_id' % model_class._meta.object_name.lower()
+
+        table = cls._gtfs_stage_tables.get(model_class)
+        if table:
+            # everything in the staging table belongs to this source
+            connection = connections[router.db_for_read(model_class)]
+            qn = connection.ops.quote_name
+            cursor = connection.cursor()
+            cursor.execute("SELECT %s, %s FROM %s" % (qn(model_class._meta.get_field(key_field).column), qn(model_class._meta.pk.column), qn(table)))
+            rows = (r for chunk in iter(lambda: cursor.fetchmany(10000), []) for r in chunk)
+        else:
+            qs = model_class._default_manager.filter(**source_query(model_class, source))
+            rows = qs.values_list(key_field, 'pk').iterator()
+
+        refs = {}
+        for key, pk in rows:
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            refs[intern(key)] = pk
+
+        L.debug("Preloaded %d %s references", len(refs), reference)
+        cls._gtfs_relation_cache[reference] = refs
+        return refs
+
+
+def source_query(model_class, source):
+    """
+    Filter arguments restricting model_class to the records belonging to source.
+    Models without a direct source FK declare the path to it in GTFS_SOURCE_FIELD.
+    """
+    return {getattr(model_class, 'GTFS_SOURCE_FIELD', 'source'): source}
+
+
+def _parse_chunk(block):
+    """
+    Parse a block of CSV lines into COPY data, in a parse process. Returns
+    (data, row count, None), or (None, rows parsed, (row, traceback)) when a row
+    can't be parsed, so the parent can log which one it was.
+    """
+    cls, source, fieldnames, plan = _parse_context
+    connection = connections[router.db_for_write(cls)]
+
+    lines = []
+    for row in csv.DictReader(block.splitlines(True), fieldnames):
+        try:
+            lines.extend(cls.gtfs_copy_lines([cls.gtfs_instantiate(source, row, plan)], connection))
+        except Exception:
+            return None, len(lines), (row, traceback.format_exc())
+    return "".join(lines), len(lines), None
+
+
+def supports_copy(using):
+    """ Whether a database can take rows via COPY ... FROM STDIN, ie. it's PostgreSQL """
+    return hasattr(connections[using].cursor(), 'copy_expert')
+
 
 class SourceBase(models.Model):
     name = models.CharField(max_length=200)
@@ -189,6 +708,7 @@ if settings.GTFS_SOURCE_MODEL == "gtfs.Source":
 
 class Agency(models.Model, GTFSModel):
     GTFS_FILENAME = 'agency.txt'
+    GTFS_KEY = ('agency_id',)
 
     source = models.ForeignKey(settings.GTFS_SOURCE_MODEL, null=True, db_index=True)
     agency_id = models.CharField(max_length=20, db_index=True)
@@ -241,6 +761,8 @@ class Stop(models.Model, GTFSModel):
 
     objects = StopManager()
 
+    GTFS_KEY = ('stop_id',)
+
     class Meta:
         unique_together = (("source", "stop_id"))
 
@@ -249,10 +771,7 @@ class Stop(models.Model, GTFSModel):
         o.location = geos.Point(float(row['stop_lon']), float(row['stop_lat']))
 
         if row.get('zone_id'):
-            try:
-                o.zone = Zone.objects.get(zone_id=row['zone_id'])
-            except Service.DoesNotExist:
-                o.zone = Zone.objects.create(source=source, zone_id=row['zone_id'])
+            o.zone_id = cls.gtfs_get_or_create_ref(Zone, source, zone_id=row['zone_id'])
 
         return ('stop_lon', 'stop_lat', 'zone_id',)
 
@@ -265,9 +784,8 @@ class Stop(models.Model, GTFSModel):
 
 class RouteManager(models.Manager):
     def between_stops(self, from_stop, to_stop):
-        """ Return all the Routes running between the specified stops """
-        trips = Trip.objects.between_stops(from_stop, to_stop)
-        return self.get_query_set().filter(trips__in=trips).distinct()
+        """ Return all the Routes running from from_stop to to_stop (see RouteStopPair) """
+        return self.get_query_set().filter(stop_pairs__from_stop=from_stop, stop_pairs__to_stop=to_stop)
 
 
 class Route(models.Model, GTFSModel):
@@ -301,6 +819,10 @@ class Route(models.Model, GTFSModel):
 
     objects = RouteManager()
 
+    GTFS_SOURCE_FIELD = 'agency__source'
+    GTFS_KEY = ('agency_id', 'route_id')
+    GTFS_DEPENDS = ('Agency',)
+
     class Meta:
         unique_together = (("agency", "route_id"))
 
@@ -312,6 +834,8 @@ class Block(models.Model, GTFSModel):
     source = models.ForeignKey(settings.GTFS_SOURCE_MODEL, null=True, db_index=True)
     block_id = models.TextField(max_length=20, db_index=True)
 
+    GTFS_KEY = ('block_id',)
+
     class Meta:
         unique_together = (("source", "block_id"))
 
@@ -321,10 +845,22 @@ class Block(models.Model, GTFSModel):
 
 class TripManager(models.Manager):
     def between_stops(self, from_stop, to_stop):
-        """ Return all the Trips running between the specified stops """
-        qs = self.get_query_set().filter(stop_times__stop=from_stop, stop_times__pickup_type=StopTime.PICKUP)
-        qs = qs.filter(stop_times__stop=to_stop, stop_times__drop_off_type=StopTime.DROPOFF)
-        return qs.distinct()
+        """
+        Return all the Trips which pick up at from_stop and later drop off at
+        to_stop. Only the trips of the routes doing so (see RouteStopPair) are
+        checked.
+        """
+        qn = connections[router.db_for_read(Trip)].ops.quote_name
+        qs = self.get_query_set().filter(route__stop_pairs__from_stop=from_stop, route__stop_pairs__to_stop=to_stop)
+        return qs.extra(where=["""
+            EXISTS (
+                SELECT 1 FROM %(stop_time)s a
+                JOIN %(stop_time)s b ON b.trip_id = a.trip_id AND b.stop_sequence > a.stop_sequence
+                WHERE a.trip_id = %(trip)s.id AND a.stop_id = %%s AND a.pickup_type = %%s
+                    AND b.stop_id = %%s AND b.drop_off_type = %%s
+            )
+        """ % {'stop_time': qn(StopTime._meta.db_table), 'trip': qn(Trip._meta.db_table)}],
+            params=[getattr(from_stop, 'pk', from_stop), StopTime.PICKUP, getattr(to_stop, 'pk', to_stop), StopTime.DROPOFF])
 
     def for_dates(self, *dates):
         return self.get_query_set().filter(service__all_dates__date__in=dates)
@@ -348,6 +884,10 @@ class Trip(models.Model, GTFSModel):
 
     objects = TripManager()
 
+    GTFS_SOURCE_FIELD = 'service__source'
+    GTFS_KEY = ('trip_id',)
+    GTFS_DEPENDS = ('Route', 'Calendar', 'CalendarDate', 'Block', 'Shape')
+
     class Meta:
         unique_together = (("service", "trip_id"), ("route", "trip_id"))
 
@@ -391,6 +931,11 @@ class StopTime(models.Model, GTFSModel):
     drop_off_type = models.IntegerField(choices=DROPOFF_TYPES, default=DROPOFF)
     shape_dist_travelled = models.FloatField(null=True)
 
+    GTFS_SOURCE_FIELD = 'trip__service__source'
+    GTFS_KEY = ('trip_id', 'stop_sequence')
+    GTFS_DEPENDS = ('Trip', 'Stop')
+    GTFS_PARALLEL_PARSE = True
+
     @classmethod
     def gtfs_populate(cls, o, row, source):
         o.arrival_time, o.arrival_days = cls.gtfs_parse_hms_days(row['arrival_time'])
@@ -433,6 +978,8 @@ class Service(models.Model):
 
 class Calendar(models.Model, GTFSModel):
     GTFS_FILENAME = 'calendar.txt'
+    GTFS_SOURCE_FIELD = 'service__source'
+    GTFS_KEY = ('service_id',)
 
     service = models.OneToOneField('Service')
     monday = models.BooleanField()
@@ -447,10 +994,7 @@ class Calendar(models.Model, GTFSModel):
 
     @classmethod
     def gtfs_populate(cls, o, row, source):
-        try:
-            o.service = Service.objects.get(service_id=row['service_id'])
-        except Service.DoesNotExist:
-            o.service = Service.objects.create(source=source, service_id=row['service_id'])
+        o.service_id = cls.gtfs_get_or_create_ref(Service, source, service_id=row['service_id'])
         return ('service_id',)
 
     def __unicode__(self):
@@ -485,12 +1029,14 @@ class CalendarDate(models.Model, GTFSModel):
     date = models.DateField()
     exception_type = models.IntegerField(choices=EXCEPTION_TYPES, db_index=True)
 
+    GTFS_SOURCE_FIELD = 'service__source'
+    GTFS_KEY = ('service_id', 'date')
+    # both create Services
+    GTFS_DEPENDS = ('Calendar',)
+
     @classmethod
     def gtfs_populate(cls, o, row, source):
-        try:
-            o.service = Service.objects.get(service_id=row['service_id'])
-        except Service.DoesNotExist:
-            o.service = Service.objects.create(source=source, service_id=row['service_id'])
+        o.service_id = cls.gtfs_get_or_create_ref(Service, source, service_id=row['service_id'])
         return ('service_id',)
 
     def __unicode__(self):
@@ -525,6 +1071,8 @@ class Fare(models.Model, GTFSModel):
     transfers = models.IntegerField(choices=TRANSFERS, null=True)
     transfer_duration = models.IntegerField()
 
+    GTFS_KEY = ('fare_id',)
+
     class Meta:
         unique_together = (("source", "fare_id"))
 
@@ -536,15 +1084,17 @@ class FareRule(models.Model, GTFSModel):
     destination = models.ForeignKey('Zone', null=True, related_name="fare_rule_destinations")
     contains = models.ForeignKey('Zone', null=True, related_name="fare_rule_contains")
 
+    GTFS_SOURCE_FIELD = 'fare__source'
+    GTFS_KEY = ('fare_id', 'route_id', 'origin_id', 'destination_id', 'contains_id')
+    # Stop for the Zones
+    GTFS_DEPENDS = ('Fare', 'Route', 'Stop')
+
     @classmethod
     def gtfs_populate(cls, o, row, source):
         for k in ('origin_id', 'destination_id', 'contains_id'):
             f = k.split('_')[0]
             if row.get(k):
-                try:
-                    setattr(o, f, Zone.objects.get(zone_id=row[k]))
-                except Zone.DoesNotExist:
-                    setattr(o, f, Zone.objects.create(source=source, zone_id=row[k]))
+                setattr(o, f + '_id', cls.gtfs_get_or_create_ref(Zone, source, zone_id=row[k]))
 
         return ('origin_id', 'destination_id', 'contains_id')
 
@@ -564,6 +1114,8 @@ class Shape(models.Model, GTFSModel):
 
     objects = models.GeoManager()
 
+    GTFS_KEY = ('shape_id',)
+
     @classmethod
     def gtfs_generate(cls, source, reader):
         shape_id = None
@@ -611,6 +1163,10 @@ class Frequency(models.Model, GTFSModel):
     end_time_days = models.IntegerField(null=True)
     headway_secs = models.IntegerField()
 
+    GTFS_SOURCE_FIELD = 'trip__service__source'
+    GTFS_KEY = ('trip_id', 'start_time', 'start_time_days')
+    GTFS_DEPENDS = ('Trip',)
+
     class Meta:
         verbose_name_plural = "Frequencies"
 
@@ -633,6 +1189,24 @@ class Transfer(models.Model, GTFSModel):
     transfer_type = models.IntegerField(choices=TRANSFER_TYPES, default=0)
     min_transfer_time = models.IntegerField(null=True)
 
+    GTFS_SOURCE_FIELD = 'from_stop__source'
+    GTFS_KEY = ('from_stop_id', 'to_stop_id')
+    GTFS_DEPENDS = ('Stop',)
+
+
+class FeedFile(models.Model):
+    """ Fingerprint of each file from the last load of a source, for differential loads """
+    source = models.ForeignKey(settings.GTFS_SOURCE_MODEL, null=True, db_index=True)
+    filename = models.CharField(max_length=100)
+    fingerprint = models.CharField(max_length=64)
+    loaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (("source", "filename"),)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.source_id, self.filename)
+
 
 class UniversalCalendar(models.Model):
     service = models.ForeignKey('Service', related_name='all_dates')
@@ -646,26 +1220,281 @@ class UniversalCalendar(models.Model):
 
     @classmethod
     def gtfs_rebuild(cls, source):
+        """
+        Expand Calendar & CalendarDate into one row per service per day. This
+        is done in a single INSERT ... SELECT using generate_series() over each
+        calendar's date range, masked by its weekdays, minus removed dates, plus
+        added ones.
+        """
         L = logging.getLogger('traveldash.gtfs.%s.gtfs_rebuild' % cls.__name__)
         L.info("Starting rebuild...")
         start_time = time.time()
 
-        # delete old records
-        cls.objects.filter(service__source=source).delete()
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fmt = {
+            'universal_calendar': qn(cls._meta.db_table),
+            'calendar': qn(Calendar._meta.db_table),
+            'calendar_date': qn(CalendarDate._meta.db_table),
+            'service': qn(Service._meta.db_table),
+            'added': CalendarDate.ADDED,
+            'removed': CalendarDate.REMOVED,
+        }
+        if source is None:
+            fmt['source_where'] = "s.source_id IS NULL"
+            source_params = []
+        else:
+            fmt['source_where'] = "s.source_id = %s"
+            source_params = [source.pk]
 
-        removes = set()
-        for e in CalendarDate.objects.filter(service__source=source).iterator():
-            if e.is_added:
-                cls.objects.create(service_id=e.service_id, date=e.date)
-            else:
-                removes.add((e.service_id, e.date))
+        cursor = connection.cursor()
 
-        for c in Calendar.objects.filter(service__source=source).iterator():
-            for d in c.get_dates():
-                if (c.service_id, d) not in removes:
-                    cls.objects.create(service_id=c.service_id, date=d)
+        # delete old records
+        cursor.execute("""
+            DELETE FROM %(universal_calendar)s
+            USING %(service)s s
+            WHERE %(universal_calendar)s.service_id = s.id AND %(source_where)s
+        """ % fmt, source_params)
+
+        cursor.execute("""
+            INSERT INTO %(universal_calendar)s (service_id, date)
+            SELECT days.service_id, days.date
+            FROM (
+                SELECT c.service_id,
+                    generate_series(c.start_date, c.end_date, interval '1 day')::date AS date,
+                    ARRAY[c.monday, c.tuesday, c.wednesday, c.thursday, c.friday, c.saturday, c.sunday] AS weekdays
+                FROM %(calendar)s c
+                JOIN %(service)s s ON s.id = c.service_id
+                WHERE %(source_where)s
+            ) AS days
+            WHERE days.weekdays[EXTRACT(isodow FROM days.date)::integer]
+                AND NOT EXISTS (
+                    SELECT 1 FROM %(calendar_date)s e
+                    WHERE e.service_id = days.service_id AND e.date = days.date AND e.exception_type = %(removed)d
+                )
+            UNION
+            SELECT e.service_id, e.date
+            FROM %(calendar_date)s e
+            JOIN %(service)s s ON s.id = e.service_id
+            WHERE %(source_where)s AND e.exception_type = %(added)d
+        """ % fmt, source_params * 2)
+        records = cursor.rowcount
+        transaction.commit_unless_managed(using=using)
 
         processing_time = time.time() - start_time
-        L.info('%s records, %s seconds', cls.objects.filter(service__source=source).count(), int(processing_time))
+        L.info('%s records, %s seconds', records, int(processing_time))
         date_range = cls.objects.filter(service__source=source).aggregate(Min('date'), Max('date'))
         L.info("Date Range: %s -> %s", date_range['date__min'], date_range['date__max'])
+
+
+class Departure(models.Model):
+    """
+    Every pickup at every stop on each day its trip runs, for a rolling window
+    of days around today, so finding the next departures from a stop is a
+    single index range scan. Rebuilt by gtfs_rebuild() after each load.
+    """
+    stop = models.ForeignKey('Stop', related_name='departures')
+    route = models.ForeignKey('Route', related_name='departures')
+    trip = models.ForeignKey('Trip', related_name='departures')
+    stop_time = models.ForeignKey('StopTime', related_name='departures')
+    service_date = models.DateField()
+    departs_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ('departs_at',)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.stop, self.departs_at)
+
+    @classmethod
+    def gtfs_window(cls, today=None):
+        """
+        The (first, last) service dates covered. Starts from yesterday, since
+        trips running past midnight belong to the previous day's service.
+        """
+        if today is None:
+            today = datetime.date.today()
+        return (today - datetime.timedelta(days=1), today + datetime.timedelta(days=GTFS_DEPARTURE_DAYS))
+
+    @classmethod
+    def gtfs_covers(cls, end_time, today=None):
+        """ Whether the departures rolled forward today run up to end_time """
+        return end_time.date() <= cls.gtfs_window(today)[1]
+
+    @classmethod
+    def gtfs_clear(cls, source):
+        """ Delete the departures for source """
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fmt = {
+            'departure': qn(cls._meta.db_table),
+            'stop': qn(Stop._meta.db_table),
+            'source_where': "s.source_id IS NULL" if source is None else "s.source_id = %s",
+        }
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            DELETE FROM %(departure)s
+            USING %(stop)s s
+            WHERE %(departure)s.stop_id = s.id AND %(source_where)s
+        """ % fmt, [] if source is None else [source.pk])
+        transaction.commit_unless_managed(using=using)
+
+    @classmethod
+    def gtfs_schedule_sql(cls, connection):
+        """
+        A SELECT generating the same columns as the departures table from
+        StopTime & UniversalCalendar, for the service dates between two
+        parameters. For queries outside the window the table covers.
+        """
+        qn = connection.ops.quote_name
+        fmt = {
+            'stop_time': qn(StopTime._meta.db_table),
+            'trip': qn(Trip._meta.db_table),
+            'universal_calendar': qn(UniversalCalendar._meta.db_table),
+            'pickup': StopTime.PICKUP,
+        }
+        return """
+            SELECT st.stop_id, t.route_id, st.trip_id, st.id AS stop_time_id, uc.date AS service_date,
+                uc.date + st.departure_days * interval '1 day' + st.departure_time * interval '1 second' AS departs_at
+            FROM %(stop_time)s st
+            JOIN %(trip)s t ON t.id = st.trip_id
+            JOIN %(universal_calendar)s uc ON uc.service_id = t.service_id
+            WHERE uc.date BETWEEN %%s AND %%s
+                AND st.pickup_type = %(pickup)d
+                AND st.departure_time IS NOT NULL
+        """ % fmt
+
+    @classmethod
+    def gtfs_rebuild(cls, source, today=None):
+        """
+        Regenerate the departures for source from StopTime & UniversalCalendar,
+        in a single INSERT ... SELECT. Needs to be re-run daily (see the
+        gtfs_update --departures command) to roll the window forward, though
+        queries past the end of it fall back to gtfs_schedule_sql().
+        """
+        L = logging.getLogger('traveldash.gtfs.%s.gtfs_rebuild' % cls.__name__)
+        L.info("Starting rebuild...")
+        start_time = time.time()
+
+        cls.gtfs_clear(source)
+
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fmt = {
+            'departure': qn(cls._meta.db_table),
+            'schedule': cls.gtfs_schedule_sql(connection),
+            'stop': qn(Stop._meta.db_table),
+            'source_where': "s.source_id IS NULL" if source is None else "s.source_id = %s",
+        }
+        first, last = cls.gtfs_window(today)
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO %(departure)s (stop_id, route_id, trip_id, stop_time_id, service_date, departs_at)
+            SELECT d.stop_id, d.route_id, d.trip_id, d.stop_time_id, d.service_date, d.departs_at
+            FROM (%(schedule)s) AS d
+            JOIN %(stop)s s ON s.id = d.stop_id
+            WHERE %(source_where)s
+        """ % fmt, [first, last] + ([] if source is None else [source.pk]))
+        records = cursor.rowcount
+        transaction.commit_unless_managed(using=using)
+
+        processing_time = time.time() - start_time
+        L.info('%s records for %s -> %s, %s seconds', records, first, last, int(processing_time))
+
+
+class RouteStopPair(models.Model):
+    """
+    Each ordered pair of stops a route takes you between, ie. a pickup at
+    from_stop followed later in the same trip by a drop off at to_stop, so
+    finding the routes between two stops is an index lookup. Rebuilt from the
+    routes' distinct stop patterns by gtfs_rebuild() after each load.
+    """
+    route = models.ForeignKey('Route', related_name='stop_pairs')
+    from_stop = models.ForeignKey('Stop', related_name='route_pairs_from')
+    to_stop = models.ForeignKey('Stop', related_name='route_pairs_to')
+
+    class Meta:
+        unique_together = (("from_stop", "to_stop", "route"),)
+
+    def __unicode__(self):
+        return u"%s: %s -> %s" % (self.route_id, self.from_stop_id, self.to_stop_id)
+
+    @classmethod
+    def gtfs_clear(cls, source):
+        """ Delete the stop pairs for source """
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fmt = {
+            'route_stop_pair': qn(cls._meta.db_table),
+            'stop': qn(Stop._meta.db_table),
+            'source_where': "s.source_id IS NULL" if source is None else "s.source_id = %s",
+        }
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            DELETE FROM %(route_stop_pair)s
+            USING %(stop)s s
+            WHERE %(route_stop_pair)s.from_stop_id = s.id AND %(source_where)s
+        """ % fmt, [] if source is None else [source.pk])
+        transaction.commit_unless_managed(using=using)
+
+    @classmethod
+    def gtfs_rebuild(cls, source):
+        """
+        Regenerate the stop pairs for source in a single INSERT ... SELECT.
+        Each trip's stops are collapsed into an array, so the pairs only need
+        expanding once per distinct pattern rather than once per trip.
+        """
+        L = logging.getLogger('traveldash.gtfs.%s.gtfs_rebuild' % cls.__name__)
+        L.info("Starting rebuild...")
+        start_time = time.time()
+
+        cls.gtfs_clear(source)
+
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fmt = {
+            'route_stop_pair': qn(cls._meta.db_table),
+            'stop_time': qn(StopTime._meta.db_table),
+            'trip': qn(Trip._meta.db_table),
+            'service': qn(Service._meta.db_table),
+            'pickup': StopTime.PICKUP,
+            'dropoff': StopTime.DROPOFF,
+            'source_where': "s.source_id IS NULL" if source is None else "s.source_id = %s",
+        }
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO %(route_stop_pair)s (route_id, from_stop_id, to_stop_id)
+            SELECT DISTINCT route_id, stops[i], stops[j]
+            FROM (
+                SELECT route_id, stops, pickups, drop_offs, i, generate_series(i + 1, array_upper(stops, 1)) AS j
+                FROM (
+                    SELECT route_id, stops, pickups, drop_offs, generate_series(1, array_upper(stops, 1)) AS i
+                    FROM (
+                        SELECT DISTINCT t.route_id,
+                            array_agg(st.stop_id ORDER BY st.stop_sequence) AS stops,
+                            array_agg(st.pickup_type ORDER BY st.stop_sequence) AS pickups,
+                            array_agg(st.drop_off_type ORDER BY st.stop_sequence) AS drop_offs
+                        FROM %(stop_time)s st
+                        JOIN %(trip)s t ON t.id = st.trip_id
+                        JOIN %(service)s s ON s.id = t.service_id
+                        WHERE %(source_where)s
+                        GROUP BY t.id, t.route_id
+                    ) AS patterns
+                ) AS froms
+            ) AS pairs
+            WHERE pickups[i] = %(pickup)d AND drop_offs[j] = %(dropoff)d AND stops[i] <> stops[j]
+        """ % fmt, [] if source is None else [source.pk])
+        records = cursor.rowcount
+        transaction.commit_unless_managed(using=using)
+
+        processing_time = time.time() - start_time
+        L.info('%s records, %s seconds', records, int(processing_time))
@@ -5,8 +5,23 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import csv
+import array
+import codecs
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from cStringIO import StringIO
+
+from django.contrib.gis.geos import Point
 from django.test import TestCase
 
+from traveldash.gtfs.models import Agency, Stop, Route, Service, Trip, StopTime, Calendar, CalendarDate, FareRule, UniversalCalendar, Departure
+from traveldash.gtfs.load import load
+from traveldash.gtfs import timetable
+from traveldash.gtfs.utils import CSVReader, UTF8Recoder
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +29,266 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class CSVReaderTest(TestCase):
+    FILE = '\r\n'.join([
+        codecs.BOM_UTF8 + 'stop_id,stop_name,stop_desc,stop_url',
+        'S1,"Queen St, Stop 1","Two\nlines",http://example.com/',
+        '',
+        'S2,K\xc5\x8dhimarama,"""Quoted"" \xe2\x80\x94 desc",',
+        'S3,Short',
+        '',
+        '"S4","Mid-field\r\nCRLF",,',
+    ]) + '\r\n'
+
+    def dict_rows(self, data):
+        return [dict(row) for row in csv.DictReader(UTF8Recoder(StringIO(data), 'utf-8-sig'))]
+
+    def reader_rows(self, reader):
+        return [dict([(k, row[k]) for k in row.keys()]) for row in reader]
+
+    def test_parity(self):
+        expected = self.dict_rows(self.FILE)
+        self.assertEqual(len(expected), 4)
+        self.assertEqual(expected[2]['stop_desc'], None)
+
+        # small buffers split quoted fields across reads
+        for buffer_size in (1, 7, 1024 * 1024):
+            reader = CSVReader(StringIO(self.FILE), buffer_size)
+            self.assertEqual(reader.fieldnames, ['stop_id', 'stop_name', 'stop_desc', 'stop_url'])
+            self.assertEqual(self.reader_rows(reader), expected, "buffer_size=%d" % buffer_size)
+
+    def test_no_bom(self):
+        data = self.FILE[len(codecs.BOM_UTF8):]
+        self.assertEqual(self.reader_rows(CSVReader(StringIO(data))), self.dict_rows(data))
+
+    def test_empty(self):
+        reader = CSVReader(StringIO(''))
+        self.assertEqual(reader.fieldnames, csv.DictReader(UTF8Recoder(StringIO(''), 'utf-8-sig')).fieldnames)
+        self.assertEqual(list(reader), [])
+
+
+class DifferentialLoadTest(TestCase):
+    FEED = {
+        'agency.txt': [
+            'agency_id,agency_name,agency_url,agency_timezone,agency_lang,agency_phone',
+            'A,Test Agency,http://example.com/,Pacific/Auckland,en,',
+        ],
+        'stops.txt': [
+            'stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,stop_url',
+            'S0,,Stop 0,,-36.85,174.76,',
+            'S1,,Stop 1,,-36.84,174.76,',
+            'S2,,Stop 2,,-36.83,174.76,',
+        ],
+        'calendar.txt': [
+            'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date',
+            'WEEKDAY,1,1,1,1,1,0,0,20120101,20121231',
+        ],
+        'calendar_dates.txt': [
+            'service_id,date,exception_type',
+            'WEEKDAY,20120102,2',
+            'WEEKDAY,20120102,2',
+        ],
+        'routes.txt': [
+            'route_id,agency_id,route_short_name,route_long_name,route_type',
+            'R1,A,1,Route 1,3',
+        ],
+        'trips.txt': [
+            'route_id,service_id,trip_id,trip_headsign',
+            'R1,WEEKDAY,T1,',
+            'R1,WEEKDAY,T2,',
+        ],
+        'stop_times.txt': [
+            'trip_id,arrival_time,departure_time,stop_id,stop_sequence',
+            'T1,08:00:00,08:00:00,S0,1',
+            'T1,08:10:00,08:10:00,S1,2',
+            'T2,09:00:00,09:00:00,S0,1',
+            'T2,09:10:00,09:10:00,S1,2',
+        ],
+        'fare_attributes.txt': [
+            'fare_id,price,currency_type,payment_method,transfers,transfer_duration',
+            'F1,2.50,NZD,0,0,0',
+        ],
+        'fare_rules.txt': [
+            'fare_id,route_id',
+            'F1,R1',
+            'F1,R1',
+        ],
+    }
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.load_feed(**self.FEED)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def load_feed(self, **files):
+        for filename, lines in files.items():
+            with open(os.path.join(self.path, filename), 'wb') as f:
+                f.write("\r\n".join(lines) + "\r\n")
+        load(self.path, None, differential=True)
+
+    def feed_file(self, filename, *lines):
+        """ The original contents of a file with lines added """
+        return self.FEED[filename] + list(lines)
+
+    def pks(self, model_class, *fields):
+        return sorted(model_class.objects.values_list(*(fields + ('pk',))))
+
+    def test_unchanged(self):
+        stops = self.pks(Stop, 'stop_id')
+        stop_times = self.pks(StopTime, 'trip__trip_id', 'stop_sequence')
+
+        # same rows, different file
+        self.load_feed(**{
+            'stops.txt': [self.FEED['stops.txt'][0]] + list(reversed(self.FEED['stops.txt'][1:])),
+            'stop_times.txt': [self.FEED['stop_times.txt'][0]] + list(reversed(self.FEED['stop_times.txt'][1:])),
+        })
+        self.assertEqual(self.pks(Stop, 'stop_id'), stops)
+        self.assertEqual(self.pks(StopTime, 'trip__trip_id', 'stop_sequence'), stop_times)
+
+    def test_changed(self):
+        stops = self.pks(Stop, 'stop_id')
+
+        lines = list(self.FEED['stops.txt'])
+        lines[2] = 'S1,,Stop One,,-36.80,174.70,'
+        self.load_feed(**{'stops.txt': lines})
+
+        self.assertEqual(self.pks(Stop, 'stop_id'), stops)
+        stop = Stop.objects.get(stop_id='S1')
+        self.assertEqual(stop.name, 'Stop One')
+        self.assertAlmostEqual(stop.location.y, -36.80)
+        self.assertAlmostEqual(stop.location.x, 174.70)
+        self.assertEqual(Stop.objects.get(stop_id='S0').name, 'Stop 0')
+
+    def test_added_and_removed(self):
+        stops = dict(Stop.objects.values_list('stop_id', 'pk'))
+
+        lines = self.FEED['stops.txt'][:3] + ['S3,,Stop 3,,-36.82,174.76,']
+        self.load_feed(**{'stops.txt': lines})
+
+        self.assertEqual(sorted(Stop.objects.values_list('stop_id', flat=True)), ['S0', 'S1', 'S3'])
+        self.assertEqual(Stop.objects.get(stop_id='S0').pk, stops['S0'])
+        self.assertEqual(Stop.objects.get(stop_id='S1').pk, stops['S1'])
+        self.assertFalse(Stop.objects.get(stop_id='S3').pk in stops.values())
+
+    def test_duplicates(self):
+        dates = self.pks(CalendarDate, 'date')
+        self.assertEqual(len(dates), 2)
+
+        # the duplicates are matched up one for one, not reinserted
+        self.load_feed(**{'calendar_dates.txt': self.feed_file('calendar_dates.txt', 'WEEKDAY,20120103,2')})
+        self.assertEqual(CalendarDate.objects.count(), 3)
+        self.assertEqual(self.pks(CalendarDate, 'date')[:2], dates)
+
+        # and the extra one goes when it's gone from the file
+        rules = self.pks(FareRule, 'route__route_id')
+        self.assertEqual(len(rules), 2)
+        self.load_feed(**{'fare_rules.txt': self.FEED['fare_rules.txt'][:2]})
+        self.assertEqual(len(self.pks(FareRule, 'route__route_id')), 1)
+        self.assertTrue(self.pks(FareRule, 'route__route_id')[0] in rules)
+
+        self.load_feed(**{'fare_rules.txt': self.feed_file('fare_rules.txt', 'F1,R1')})
+        self.assertEqual(FareRule.objects.count(), 3)
+
+    def test_trip_cascade(self):
+        stop_times = self.pks(StopTime, 'trip__trip_id', 'stop_sequence')
+
+        # stop_times.txt is unchanged, so it's skipped
+        self.load_feed(**{'trips.txt': self.FEED['trips.txt'][:2]})
+
+        self.assertEqual(list(Trip.objects.values_list('trip_id', flat=True)), ['T1'])
+        self.assertEqual(self.pks(StopTime, 'trip__trip_id', 'stop_sequence'), [st for st in stop_times if st[0] == 'T1'])
+
+
+class RebuildTest(TestCase):
+    def setUp(self):
+        self.weekday = Service.objects.create(source=None, service_id='WEEKDAY')
+        # weekdays from Tuesday the 3rd to Thursday the 12th
+        Calendar.objects.create(service=self.weekday, monday=True, tuesday=True, wednesday=True, thursday=True, friday=True,
+                                saturday=False, sunday=False, start_date=date(2012, 1, 3), end_date=date(2012, 1, 12))
+        CalendarDate.objects.create(service=self.weekday, date=date(2012, 1, 4), exception_type=CalendarDate.REMOVED)
+        CalendarDate.objects.create(service=self.weekday, date=date(2012, 1, 7), exception_type=CalendarDate.ADDED)
+        CalendarDate.objects.create(service=self.weekday, date=date(2012, 1, 20), exception_type=CalendarDate.ADDED)
+
+        self.weekend = Service.objects.create(source=None, service_id='WEEKEND')
+        Calendar.objects.create(service=self.weekend, monday=False, tuesday=False, wednesday=False, thursday=False, friday=False,
+                                saturday=True, sunday=True, start_date=date(2012, 1, 1), end_date=date(2012, 1, 8))
+
+        self.special = Service.objects.create(source=None, service_id='SPECIAL')
+        CalendarDate.objects.create(service=self.special, date=date(2012, 2, 1), exception_type=CalendarDate.ADDED)
+
+    def dates(self, service):
+        return list(UniversalCalendar.objects.filter(service=service).order_by('date').values_list('date', flat=True))
+
+    def test_universal_calendar(self):
+        UniversalCalendar.gtfs_rebuild(None)
+        # again, replacing the first lot
+        UniversalCalendar.gtfs_rebuild(None)
+
+        # the 4th removed, the Saturday 7th & the 20th (outside the range) added
+        self.assertEqual(self.dates(self.weekday), [date(2012, 1, d) for d in (3, 5, 6, 7, 9, 10, 11, 12, 20)])
+        self.assertEqual(self.dates(self.weekend), [date(2012, 1, d) for d in (1, 7, 8)])
+        self.assertEqual(self.dates(self.special), [date(2012, 2, 1)])
+
+    def test_departures(self):
+        agency = Agency.objects.create(source=None, agency_id='A', name='Test Agency', url='http://example.com/', timezone='Pacific/Auckland', lang='en', phone='')
+        route = Route.objects.create(agency=agency, route_id='R1', short_name='1', long_name='Route 1', route_type=Route.BUS)
+        trip = Trip.objects.create(route=route, service=self.weekday, trip_id='T1', headsign='', short_name='')
+        stops = [Stop.objects.create(source=None, stop_id='S%d' % i, code='', name='Stop %d' % i, desc='', url='', location=Point(174.76, -36.85 + i * 0.01)) for i in range(3)]
+        morning = StopTime.objects.create(trip=trip, stop=stops[0], stop_sequence=1, stop_headsign='',
+                                          arrival_time=8 * 3600, arrival_days=0, departure_time=8 * 3600, departure_days=0)
+        # 25:30:00, after midnight
+        late = StopTime.objects.create(trip=trip, stop=stops[1], stop_sequence=2, stop_headsign='',
+                                       arrival_time=5400, arrival_days=1, departure_time=5400, departure_days=1)
+        StopTime.objects.create(trip=trip, stop=stops[2], stop_sequence=3, stop_headsign='', pickup_type=1,
+                                arrival_time=6000, arrival_days=1, departure_time=6000, departure_days=1)
+        UniversalCalendar.gtfs_rebuild(None)
+        stale = Departure.objects.create(stop=stops[0], route=route, trip=trip, stop_time=morning,
+                                         service_date=date(2011, 1, 1), departs_at=datetime(2011, 1, 1, 8, 0))
+
+        today = date(2012, 1, 10)
+        Departure.gtfs_rebuild(None, today)
+
+        first, last = Departure.gtfs_window(today)
+        service_dates = [d for d in self.dates(self.weekday) if first <= d <= last]
+        self.assertTrue(service_dates)
+        self.assertFalse(Departure.objects.filter(pk=stale.pk).exists())
+        # nothing from the stop time without pickups
+        expected = sorted([(morning.pk, d, datetime(d.year, d.month, d.day, 8, 0)) for d in service_dates] +
+                          [(late.pk, d, datetime(d.year, d.month, d.day, 1, 30) + timedelta(days=1)) for d in service_dates])
+        self.assertEqual(sorted(Departure.objects.values_list('stop_time', 'service_date', 'departs_at')), expected)
+        self.assertEqual(set(Departure.objects.values_list('route', 'trip')), set([(route.pk, trip.pk)]))
+
+
+class TimetableFileTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.old_dir = timetable.GTFS_TIMETABLE_DIR
+        timetable.GTFS_TIMETABLE_DIR = self.path
+
+    def tearDown(self):
+        for tt in timetable._timetables.values():
+            tt[1].close()
+        timetable._timetables.clear()
+        timetable.GTFS_TIMETABLE_DIR = self.old_dir
+        shutil.rmtree(self.path)
+
+    def test_column_names(self):
+        columns = [('meta', array.array('i', [date(2012, 1, 2).toordinal(), 1, 1, 0]))]
+        columns += timetable._strings('trip_headsign', [u'Britomart', u'Caf\xe9'])
+        columns += timetable._strings('trip_short_name', [u'', u'X'])
+        timetable.write(timetable.timetable_path(None), columns)
+
+        tt = timetable.get(None)
+        self.assertEqual(tt.string('trip_headsign', 1), u'Caf\xe9')
+        self.assertEqual(tt.string('trip_short_name', 1), u'X')
+
+        self.assertRaises(ValueError, timetable.write, timetable.timetable_path(None), [('x' * (timetable.TOC_NAME_SIZE + 1), array.array('i'))])
+
+    def test_old_version(self):
+        with open(timetable.timetable_path(None), 'wb') as f:
+            f.write(timetable.HEADER.pack(timetable.MAGIC, timetable.VERSION - 1, -1, 0, '', 0))
+        self.assertEqual(timetable.get(None), None)
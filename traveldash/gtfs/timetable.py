@@ -0,0 +1,446 @@
+"""
+Compact read-only timetables, for answering departure queries without the
+database.
+
+A source's stop times, trips & service calendars are written to a single file
+of flat integer columns after each load is committed (see build()). Web processes mmap()
+it, so they all share the one copy through the page cache, and find the next
+departures from a stop with a binary search over its departure times.
+
+Files start with a header (see HEADER) of the magic number, format version,
+source id (-1 for none), build time, a hash of the feed files loaded (from
+FeedFile), and the number of columns, followed by a table of contents of
+(name, 'i' or 'c', byte offset, length) for each column, then the columns.
+Column names can be up to TOC_NAME_SIZE bytes.
+New files are written alongside and renamed into place, and get() notices &
+opens the new one, so readers never see a half-written file. That's done once
+the load's committed, so they never see data the database doesn't have yet.
+
+Columns (all native-endian 32-bit ints unless noted):
+
+    meta              base date ordinal, number of days, bytes per service in
+                      service_days, most days a trip runs past its service date
+    service_pk        Service ids
+    service_days      (bytes) per service, a bitmap of the days from the base
+                      date it runs on
+    route_pk          distinct Route ids
+    trip_pk, trip_route, trip_service (index into service_pk), trip_direction
+                      (-1 for none), trip_stop_times (offsets into st_*, one
+                      more than the number of trips)
+    trip_id, trip_headsign, trip_short_name
+                      (bytes) UTF-8 strings, with *_offsets columns
+    st_trip, st_stop, st_arrival
+                      stop times, by trip & stop_sequence. Arrivals are
+                      seconds after the service date's midnight, -1 where
+                      there's no drop off
+    stop_pk           Stop ids, sorted
+    stop_departures   offsets into dep_*, one more than the number of stops
+    dep_time, dep_stop_time
+                      pickups at each stop, by departure seconds after
+                      midnight, and the index of the stop time
+"""
+import os
+import mmap
+import time
+import array
+import bisect
+import struct
+import logging
+import hashlib
+import datetime
+import heapq
+
+from django.conf import settings
+from django.db import connections, router
+
+from traveldash.gtfs.models import Service, UniversalCalendar, Trip, StopTime, Route, FeedFile, GTFS_DEPARTURE_DAYS
+
+# Where to keep the timetable files. None disables them, and departures
+# come from the database.
+GTFS_TIMETABLE_DIR = getattr(settings, 'GTFS_TIMETABLE_DIR', None)
+
+MAGIC = 'TDTT'
+VERSION = 2
+HEADER = struct.Struct('=4sIid64sI')
+TOC_NAME_SIZE = 32
+_toc_entry = struct.Struct('=%dscII' % TOC_NAME_SIZE)
+_int = struct.Struct('=i')
+
+# open timetables, by source id: ((inode, mtime), Timetable)
+_timetables = {}
+
+
+class Column(object):
+    """ A read-only sequence of ints in a buffer, which bisect can search """
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return _int.unpack_from(self.buf, self.offset + i * _int.size)[0]
+
+
+class Timetable(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, source_id, built_at, feed_hash, count = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s isn't a timetable" % path)
+        if version != VERSION:
+            raise ValueError("%s is a version %s timetable, expected %s" % (path, version, VERSION))
+        self.source_id = source_id if source_id >= 0 else None
+        self.built_at = datetime.datetime.fromtimestamp(built_at)
+        self.feed_hash = feed_hash.rstrip('\0')
+
+        for i in range(count):
+            name, typecode, offset, length = _toc_entry.unpack_from(self.buf, HEADER.size + i * _toc_entry.size)
+            if typecode == 'c':
+                column = buffer(self.buf, offset, length)
+            else:
+                column = Column(self.buf, offset, length)
+            setattr(self, name.rstrip('\0'), column)
+
+        self.base_date = datetime.date.fromordinal(self.meta[0])
+        self.days = self.meta[1]
+        self.service_bytes = self.meta[2]
+        self.max_days = self.meta[3]
+        self._routes = None
+
+    def close(self):
+        self.buf.close()
+
+    def runs_on(self, service, day):
+        day = day.toordinal() - self.base_date.toordinal()
+        if not 0 <= day < self.days:
+            return False
+        return bool(ord(self.service_days[service * self.service_bytes + day // 8]) & (1 << (day % 8)))
+
+    def string(self, name, i):
+        offsets = getattr(self, name + '_offsets')
+        return getattr(self, name)[offsets[i]:offsets[i + 1]].decode('utf-8')
+
+    def routes(self):
+        """
+        The Routes in the timetable, by id. Fetched once per process, unless
+        some are missing, in which case they're fetched again next time.
+        """
+        if self._routes is not None:
+            return self._routes
+        routes = Route.objects.in_bulk(list(self.route_pk))
+        if len(routes) == len(self.route_pk):
+            self._routes = routes
+        return routes
+
+    def trip(self, i):
+        """ The Trip at index i, with its Route attached """
+        direction = self.trip_direction[i]
+        trip = Trip(id=self.trip_pk[i], route_id=self.trip_route[i], service_id=self.service_pk[self.trip_service[i]],
+                    direction_id=None if direction < 0 else direction, trip_id=self.string('trip_id', i),
+                    headsign=self.string('trip_headsign', i), short_name=self.string('trip_short_name', i))
+        route = self.routes().get(trip.route_id)
+        if route is not None:
+            setattr(trip, Trip._meta.get_field('route').get_cache_name(), route)
+        return trip
+
+    def _arrival(self, st, to_stop_id):
+        """ Seconds after midnight of the trip's next drop off at to_stop_id after stop time st, or None """
+        trip = self.st_trip[st]
+        for j in xrange(st + 1, self.trip_stop_times[trip + 1]):
+            if self.st_stop[j] == to_stop_id and self.st_arrival[j] >= 0:
+                return self.st_arrival[j]
+        return None
+
+    def _day_departures(self, lo, hi, day, start_time, route_ids, to_stop_id):
+        midnight = datetime.datetime(day.year, day.month, day.day)
+        after = start_time - midnight
+        after = after.days * 86400 + after.seconds + (1 if after.microseconds else 0)
+        for i in xrange(bisect.bisect_left(self.dep_time, after, lo, hi), hi):
+            st = self.dep_stop_time[i]
+            trip = self.st_trip[st]
+            if route_ids is not None and self.trip_route[trip] not in route_ids:
+                continue
+            if not self.runs_on(self.trip_service[trip], day):
+                continue
+            arrives = None
+            if to_stop_id is not None:
+                arrives = self._arrival(st, to_stop_id)
+                if arrives is None:
+                    continue
+                arrives = midnight + datetime.timedelta(seconds=arrives)
+            yield (midnight + datetime.timedelta(seconds=self.dep_time[i]), day, trip, arrives)
+
+    def departures(self, stop_id, start_time, route_ids=None, to_stop_id=None):
+        """
+        Generate (departing, service date, trip index, arriving) for the
+        pickups at stop_id from start_time onwards, in departure order, as
+        far ahead as Departure covers. route_ids optionally restricts them to
+        a set of Route ids. If to_stop_id is given only trips which then drop
+        off there are included, and arriving is when, otherwise it's None.
+        """
+        si = bisect.bisect_left(self.stop_pk, stop_id)
+        if si == len(self.stop_pk) or self.stop_pk[si] != stop_id:
+            return
+        lo, hi = self.stop_departures[si], self.stop_departures[si + 1]
+
+        # trips running past midnight belong to an earlier day's service
+        day = max(start_time.date() - datetime.timedelta(days=self.max_days), self.base_date)
+        last_day = min(start_time.date() + datetime.timedelta(days=GTFS_DEPARTURE_DAYS),
+                       self.base_date + datetime.timedelta(days=self.days - 1))
+
+        # a day's departures are all after its midnight, so only start on the
+        # next day once everything earlier has gone
+        heap = []
+        while True:
+            while day <= last_day and (not heap or heap[0][0] >= datetime.datetime(day.year, day.month, day.day)):
+                departures = self._day_departures(lo, hi, day, start_time, route_ids, to_stop_id)
+                d = next(departures, None)
+                if d is not None:
+                    heapq.heappush(heap, d + (departures,))
+                day += datetime.timedelta(days=1)
+            if not heap:
+                return
+
+            d = heapq.heappop(heap)
+            departures = d[-1]
+            yield d[:-1]
+            d = next(departures, None)
+            if d is not None:
+                heapq.heappush(heap, d + (departures,))
+
+
+def timetable_path(source_id):
+    return os.path.join(GTFS_TIMETABLE_DIR, 'timetable-%s.bin' % (source_id if source_id is not None else 'none'))
+
+
+def get(source_id):
+    """
+    The Timetable for source_id, or None if there isn't one (or they're
+    disabled, or it can't be read). Re-opened when a new one's been written.
+    """
+    if not GTFS_TIMETABLE_DIR:
+        return None
+
+    path = timetable_path(source_id)
+    try:
+        st = os.stat(path)
+    except OSError:
+        _timetables.pop(source_id, None)
+        return None
+
+    # the old one's unmapped once anything still using it has finished
+    stamp = (st.st_ino, st.st_mtime)
+    if source_id not in _timetables or _timetables[source_id][0] != stamp:
+        try:
+            _timetables[source_id] = (stamp, Timetable(path))
+        except (ValueError, EnvironmentError, struct.error):
+            logging.getLogger('traveldash.gtfs.timetable.get').warning("Can't open timetable %s", path, exc_info=True)
+            _timetables.pop(source_id, None)
+            return None
+    return _timetables[source_id][1]
+
+
+def feed_hash(source):
+    """ A hash of the files last loaded for source """
+    h = hashlib.sha256()
+    for filename, fingerprint in FeedFile.objects.filter(source=source).order_by('filename').values_list('filename', 'fingerprint'):
+        h.update("%s:%s\n" % (filename, fingerprint))
+    return h.hexdigest()
+
+
+def write(path, columns, source_id=None, built_at=None, feed_hash=''):
+    """
+    Write a timetable file from a list of (name, array or str). It's written
+    to a temporary file and renamed over path, so it's replaced atomically.
+    """
+    if built_at is None:
+        built_at = time.time()
+
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            _write(f, columns, source_id, built_at, feed_hash)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _write(f, columns, source_id, built_at, feed_hash):
+    f.write(HEADER.pack(MAGIC, VERSION, -1 if source_id is None else source_id, built_at, feed_hash, len(columns)))
+    offset = HEADER.size + len(columns) * _toc_entry.size
+    for name, data in columns:
+        # struct would quietly cut it short
+        if len(name) > TOC_NAME_SIZE:
+            raise ValueError("Timetable column name %r is longer than %d bytes" % (name, TOC_NAME_SIZE))
+        if isinstance(data, str):
+            f.write(_toc_entry.pack(name, 'c', offset, len(data)))
+            offset += len(data)
+        else:
+            f.write(_toc_entry.pack(name, 'i', offset, len(data)))
+            offset += len(data) * data.itemsize
+    for name, data in columns:
+        if isinstance(data, str):
+            f.write(data)
+        else:
+            data.tofile(f)
+
+
+def _strings(name, values):
+    offsets = array.array('i', [0])
+    data = []
+    for v in values:
+        v = (v or u'').encode('utf-8')
+        data.append(v)
+        offsets.append(offsets[-1] + len(v))
+    return [(name, ''.join(data)), (name + '_offsets', offsets)]
+
+
+def build(source, path=None):
+    """
+    Write the timetable for source from the database, to path or its place in
+    GTFS_TIMETABLE_DIR. Only call this once the load has been committed, as
+    web processes pick it up straight away.
+    """
+    L = logging.getLogger('traveldash.gtfs.timetable.build')
+    L.info("Building timetable...")
+    start_time = time.time()
+
+    if path is None:
+        path = timetable_path(source.pk if source is not None else None)
+
+    connection = connections[router.db_for_read(StopTime)]
+    qn = connection.ops.quote_name
+    fmt = {
+        'service': qn(Service._meta.db_table),
+        'universal_calendar': qn(UniversalCalendar._meta.db_table),
+        'trip': qn(Trip._meta.db_table),
+        'stop_time': qn(StopTime._meta.db_table),
+        'source_where': "s.source_id IS NULL" if source is None else "s.source_id = %s",
+    }
+    params = [] if source is None else [source.pk]
+    cursor = connection.cursor()
+
+    # services & the days they run
+    cursor.execute("SELECT s.id FROM %(service)s s WHERE %(source_where)s ORDER BY s.id" % fmt, params)
+    service_pk = array.array('i', [row[0] for row in cursor.fetchall()])
+    service_index = dict([(pk, i) for i, pk in enumerate(service_pk)])
+
+    cursor.execute("""
+        SELECT uc.service_id, uc.date
+        FROM %(universal_calendar)s uc
+        JOIN %(service)s s ON s.id = uc.service_id
+        WHERE %(source_where)s
+    """ % fmt, params)
+    dates = cursor.fetchall()
+    if dates:
+        base = min([d for s, d in dates]).toordinal()
+        days = max([d for s, d in dates]).toordinal() - base + 1
+    else:
+        base, days = datetime.date.today().toordinal(), 0
+    service_bytes = (days + 7) // 8
+    service_days = array.array('B', [0]) * (len(service_pk) * service_bytes)
+    for service_id, date in dates:
+        day = date.toordinal() - base
+        service_days[service_index[service_id] * service_bytes + day // 8] |= 1 << (day % 8)
+
+    # trips
+    cursor.execute("""
+        SELECT t.id, t.route_id, t.service_id, t.direction_id, t.trip_id, t.headsign, t.short_name
+        FROM %(trip)s t
+        JOIN %(service)s s ON s.id = t.service_id
+        WHERE %(source_where)s
+        ORDER BY t.id
+    """ % fmt, params)
+    trips = cursor.fetchall()
+    trip_pk = array.array('i', [t[0] for t in trips])
+    trip_route = array.array('i', [t[1] for t in trips])
+    trip_service = array.array('i', [service_index[t[2]] for t in trips])
+    trip_direction = array.array('i', [-1 if t[3] is None else t[3] for t in trips])
+    trip_index = dict([(pk, i) for i, pk in enumerate(trip_pk)])
+
+    # stop times, by trip
+    cursor.execute("""
+        SELECT st.trip_id, st.stop_id,
+            st.arrival_time + st.arrival_days * 86400, st.departure_time + st.departure_days * 86400,
+            st.pickup_type, st.drop_off_type
+        FROM %(stop_time)s st
+        JOIN %(trip)s t ON t.id = st.trip_id
+        JOIN %(service)s s ON s.id = t.service_id
+        WHERE %(source_where)s
+        ORDER BY t.id, st.stop_sequence
+    """ % fmt, params)
+    st_trip, st_stop, st_arrival = array.array('i'), array.array('i'), array.array('i')
+    trip_stop_times = array.array('i', [0] * (len(trip_pk) + 1))
+    pickups = []
+    max_time = 0
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        for trip_id, stop_id, arrival, departure, pickup_type, drop_off_type in rows:
+            trip = trip_index[trip_id]
+            if departure is not None and pickup_type == StopTime.PICKUP:
+                pickups.append((stop_id, departure, len(st_trip)))
+                max_time = max(max_time, departure)
+            st_trip.append(trip)
+            st_stop.append(stop_id)
+            st_arrival.append(arrival if arrival is not None and drop_off_type == StopTime.DROPOFF else -1)
+            trip_stop_times[trip + 1] = len(st_trip)
+    for i in range(1, len(trip_stop_times)):
+        # trips without any stop times
+        trip_stop_times[i] = max(trip_stop_times[i], trip_stop_times[i - 1])
+
+    # departures, by stop
+    pickups.sort()
+    stop_pk, stop_departures = array.array('i'), array.array('i')
+    dep_time = array.array('i', [p[1] for p in pickups])
+    dep_stop_time = array.array('i', [p[2] for p in pickups])
+    for i, p in enumerate(pickups):
+        if not stop_pk or stop_pk[-1] != p[0]:
+            stop_pk.append(p[0])
+            stop_departures.append(i)
+    stop_departures.append(len(pickups))
+    del pickups
+
+    columns = [
+        ('meta', array.array('i', [base, days, service_bytes, max_time // 86400])),
+        ('service_pk', service_pk),
+        ('service_days', service_days.tostring()),
+        ('route_pk', array.array('i', sorted(set(trip_route)))),
+        ('trip_pk', trip_pk),
+        ('trip_route', trip_route),
+        ('trip_service', trip_service),
+        ('trip_direction', trip_direction),
+        ('trip_stop_times', trip_stop_times),
+    ]
+    columns += _strings('trip_id', [t[4] for t in trips])
+    columns += _strings('trip_headsign', [t[5] for t in trips])
+    columns += _strings('trip_short_name', [t[6] for t in trips])
+    columns += [
+        ('st_trip', st_trip),
+        ('st_stop', st_stop),
+        ('st_arrival', st_arrival),
+        ('stop_pk', stop_pk),
+        ('stop_departures', stop_departures),
+        ('dep_time', dep_time),
+        ('dep_stop_time', dep_stop_time),
+    ]
+    write(path, columns, source.pk if source is not None else None, feed_hash=feed_hash(source))
+
+    processing_time = time.time() - start_time
+    L.info('%s departures from %s stops, %s seconds', len(dep_time), len(stop_pk), int(processing_time))
+    return path
@@ -1,4 +1,8 @@
+import os
+import csv
 import codecs
+import hashlib
+import zipfile
 
 
 class UTF8Recoder(object):
@@ -14,3 +18,175 @@ class UTF8Recoder(object):
 
     def next(self):
         return self.reader.next().encode('utf-8')
+
+
+class CSVRow(tuple):
+    """
+    A row from CSVReader: a tuple of the column values, which can also be
+    looked up by column name like the dicts csv.DictReader gives.
+    Subclassed per file by csv_row_class() to attach the header.
+    """
+    __slots__ = ()
+    fieldnames = ()
+    index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            i = self.index[key]
+            # short rows are padded with None, like DictReader does
+            return tuple.__getitem__(self, i) if i < len(self) else None
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self.index:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.fieldnames)
+
+
+def csv_row_class(fieldnames):
+    fieldnames = tuple(fieldnames)
+    index = dict([(k, i) for i, k in enumerate(fieldnames)])
+    return type('CSVRow', (CSVRow,), {'__slots__': (), 'fieldnames': fieldnames, 'index': index})
+
+
+class CSVReader(object):
+    """
+    A faster replacement for csv.DictReader(UTF8Recoder(f, 'utf-8-sig')) on
+    UTF-8 files. The BOM is checked for once, lines are split out of large
+    buffered reads and passed straight to the CSV parser without being
+    decoded & re-encoded, and rows are CSVRow tuples rather than dicts.
+    Unlike UTF8Recoder, invalid UTF-8 isn't detected here.
+    """
+    def __init__(self, f, buffer_size=1024 * 1024):
+        self.reader = csv.reader(self._lines(f, buffer_size))
+        self._fieldnames = None
+        self.row_class = None
+
+    @staticmethod
+    def _lines(f, buffer_size):
+        for block in read_chunks(f, buffer_size):
+            for line in block.splitlines(True):
+                yield line
+
+    @property
+    def fieldnames(self):
+        if self.row_class is None:
+            header = next(self.reader, [])
+            if header and header[0].startswith(codecs.BOM_UTF8):
+                header[0] = header[0][len(codecs.BOM_UTF8):]
+            self.row_class = csv_row_class(header)
+        return list(self.row_class.fieldnames) or None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.row_class is None:
+            self.fieldnames
+        row = self.reader.next()
+        while not row:
+            # skip blank lines, like DictReader
+            row = self.reader.next()
+        return self.row_class(row)
+
+
+def copy_line(values):
+    """
+    Format a sequence of column values as a line of PostgreSQL COPY text format.
+    Values should already be prepared for the database (ie. via get_db_prep_save)
+    """
+    line = []
+    for v in values:
+        if v is None:
+            line.append('\\N')
+            continue
+        elif isinstance(v, bool):
+            v = 't' if v else 'f'
+        elif isinstance(v, unicode):
+            v = v.encode('utf-8')
+        elif isinstance(v, float):
+            v = repr(v)
+        elif not isinstance(v, str):
+            v = str(v)
+        line.append(v.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r'))
+    return '\t'.join(line) + '\n'
+
+
+def read_chunks(f, size):
+    """ Read a file in blocks of roughly size bytes, each ending on a line boundary """
+    while True:
+        block = f.read(size)
+        if not block:
+            break
+        yield block + f.readline()
+
+
+def file_fingerprint(path):
+    """ SHA-1 of a file's contents """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DirectoryFeed(object):
+    """ A GTFS feed that's been extracted into a directory """
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self, filename):
+        return os.path.exists(os.path.join(self.path, filename))
+
+    def open(self, filename):
+        return open(os.path.join(self.path, filename), 'rb')
+
+    def fingerprint(self, filename):
+        return file_fingerprint(os.path.join(self.path, filename))
+
+    def clone(self):
+        return self
+
+    def close(self):
+        pass
+
+
+class ZipFeed(object):
+    """
+    A GTFS feed read straight out of its ZIP file. Members are decompressed as
+    they're read, so nothing needs to be extracted to disk.
+    """
+    def __init__(self, zip_file):
+        self.zip = zipfile.ZipFile(zip_file)
+
+    def exists(self, filename):
+        try:
+            self.zip.getinfo(filename)
+        except KeyError:
+            return False
+        return True
+
+    def open(self, filename):
+        return self.zip.open(filename)
+
+    def fingerprint(self, filename):
+        # the CRC & size are in the ZIP directory already, no need to read the data
+        info = self.zip.getinfo(filename)
+        return "%08x:%d" % (info.CRC & 0xffffffff, info.file_size)
+
+    def clone(self):
+        # ZipFile objects can't be shared between threads, so each gets its own
+        return ZipFeed(open(self.zip.filename, 'rb'))
+
+    def close(self):
+        self.zip.close()
+
+
+def open_feed(feed):
+    """ Return a *Feed object for a directory path, or pass through an existing one """
+    if isinstance(feed, basestring):
+        return DirectoryFeed(feed)
+    return feed
@@ -70,7 +70,7 @@ class DashboardAdmin(admin.ModelAdmin):
 
 
 class GTFSSourceAdmin(admin.ModelAdmin):
-    list_display = ('name', 'city', 'get_can_autoupdate', 'last_update', 'update_freq',)
+    list_display = ('name', 'city', 'get_can_autoupdate', 'last_update', 'update_freq', 'next_update_at',)
 
     def get_can_autoupdate(self, obj):
         return obj.can_autoupdate
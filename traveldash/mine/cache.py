@@ -0,0 +1,244 @@
+"""
+Caching of the dashboard JSON served to polling clients.
+
+Entries are keyed on the dashboard, the current minute, and two version
+stamps: one for the GTFS data & alerts as a whole, bumped after loads, and one
+per dashboard, bumped whenever it or its routes are edited. Bumping a stamp
+orphans the old entries rather than deleting them, they just expire.
+"""
+import json
+import time
+import random
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min, Max
+
+# How long a dashboard's JSON is kept for (seconds). Entries are only ever
+# used within their minute anyway.
+DASHBOARD_CACHE_TIMEOUT = getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 120)
+
+# Longest a request will wait for another one to finish building the same
+# entry before doing it itself (seconds)
+DASHBOARD_CACHE_WAIT = 5
+
+# How often clients of the event stream reconnect for changes (seconds). By
+# default as often as dashboard.js polls without it, so streaming clients
+# don't cost more.
+DASHBOARD_EVENTS_RETRY = getattr(settings, 'DASHBOARD_EVENTS_RETRY', 5 * 60)
+
+# How long past versions of a dashboard's JSON are kept for working out what's
+# changed since a client last saw it (seconds)
+DASHBOARD_HISTORY_TIMEOUT = 15 * 60
+
+# Version stamps shouldn't expire (30 days is memcached's limit)
+VERSION_TIMEOUT = 30 * 86400
+
+DATA_VERSION_KEY = 'traveldash:data-version'
+
+# Pool of dashboards to pick the home page example from
+EXAMPLE_DASHBOARDS_KEY = 'traveldash:example-dashboards'
+EXAMPLE_DASHBOARDS_SIZE = 500
+EXAMPLE_DASHBOARDS_TIMEOUT = 60 * 60
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        # start from the clock so a lost stamp doesn't go back to an old value
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # not in the cache
+        version = int(time.time() * 1000)
+        cache.set(key, version, VERSION_TIMEOUT)
+        return version
+
+
+def data_version():
+    return _version(DATA_VERSION_KEY)
+
+
+def bump_data_version():
+    """ Invalidate every dashboard, eg. after a GTFS load or an alert change """
+    return _bump(DATA_VERSION_KEY)
+
+
+def dashboard_version(dashboard_id):
+    return _version('traveldash:dashboard-version:%s' % dashboard_id)
+
+
+def bump_dashboard_version(dashboard_id):
+    """ Invalidate a single dashboard after it's been edited """
+    return _bump('traveldash:dashboard-version:%s' % dashboard_id)
+
+
+def source_versions():
+    """
+    {source id: GTFSSource.feed_version} for all the sources. Cached until
+    the data version is next bumped.
+    """
+    from traveldash.mine.models import GTFSSource
+
+    key = 'traveldash:source-versions:%s' % data_version()
+    versions = cache.get(key)
+    if versions is None:
+        versions = dict([(source.pk, source.feed_version) for source in GTFSSource.objects.all()])
+        cache.set(key, versions, VERSION_TIMEOUT)
+    return versions
+
+
+def example_dashboard_id():
+    """
+    The pk of a random dashboard with routes to show off on the home page, or
+    None. Picked from a pool which is refreshed hourly, or after a dashboard's
+    deleted. Only one request rebuilds the pool, the rest go without an
+    example meanwhile.
+    """
+    pool = cache.get(EXAMPLE_DASHBOARDS_KEY)
+    if pool is None:
+        lock_key = EXAMPLE_DASHBOARDS_KEY + ':lock'
+        if not cache.add(lock_key, 1, DASHBOARD_CACHE_WAIT * 2):
+            # somebody else is building it
+            return None
+        try:
+            pool = _example_dashboards()
+            cache.set(EXAMPLE_DASHBOARDS_KEY, pool, EXAMPLE_DASHBOARDS_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+
+    if not pool:
+        return None
+    return random.choice(pool)
+
+
+def _example_dashboards():
+    """
+    Up to EXAMPLE_DASHBOARDS_SIZE ids of dashboards with routes, in pk order
+    from a random point in the pk range (wrapping around), rather than
+    shuffling the whole table.
+    """
+    from traveldash.mine.models import Dashboard, DashboardRoute
+
+    bounds = Dashboard.objects.aggregate(Min('pk'), Max('pk'))
+    if bounds['pk__min'] is None:
+        return []
+    start = random.randint(bounds['pk__min'], bounds['pk__max'])
+
+    # a semi-join, so dashboards with more routes aren't any more likely
+    qs = Dashboard.objects.filter(pk__in=DashboardRoute.objects.values('dashboard')).order_by('pk').values_list('pk', flat=True)
+    pool = list(qs.filter(pk__gte=start)[:EXAMPLE_DASHBOARDS_SIZE])
+    if len(pool) < EXAMPLE_DASHBOARDS_SIZE:
+        pool += list(qs.filter(pk__lt=start)[:EXAMPLE_DASHBOARDS_SIZE - len(pool)])
+    return pool
+
+
+def reset_example_dashboards():
+    cache.delete(EXAMPLE_DASHBOARDS_KEY)
+
+
+def _build(dashboard, start_time):
+    content = json.dumps(dashboard.as_json(start_time))
+    etag = hashlib.md5(content).hexdigest()
+    # so dashboard_events() can diff against it later
+    cache.set('traveldash:dashboard-content:%s' % etag, content, DASHBOARD_HISTORY_TIMEOUT)
+    return (etag, content)
+
+
+def dashboard_json(dashboard, now=None):
+    """
+    The JSON for Dashboard.as_json() as of the start of the current minute,
+    from the cache if possible. When it needs building, only one request does
+    it while the others wait for the result.
+    Returns (etag, content), where etag is a hash of the content so clients
+    can tell whether it's changed.
+    """
+    if now is None:
+        now = datetime.now()
+    start_time = now.replace(second=0, microsecond=0)
+
+    key = 'traveldash:dashboard:%s:%s:%s:%s' % (dashboard.pk, start_time.strftime('%Y%m%d%H%M'), data_version(), dashboard_version(dashboard.pk))
+    entry = cache.get(key)
+    if entry is not None:
+        return entry
+
+    lock_key = key + ':lock'
+    if not cache.add(lock_key, 1, DASHBOARD_CACHE_WAIT * 2):
+        # somebody else is building it
+        for i in range(DASHBOARD_CACHE_WAIT * 10):
+            time.sleep(0.1)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+        # taking too long, do it ourselves
+        return _build(dashboard, start_time)
+
+    try:
+        entry = _build(dashboard, start_time)
+        cache.set(key, entry, DASHBOARD_CACHE_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+    return entry
+
+
+def _event(event_id, event, data):
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (event_id, event, data)
+
+
+def _delta(old, new):
+    """ What's changed between two versions of a dashboard's JSON """
+    old, new = json.loads(old), json.loads(new)
+    old_trips = set([d['trip']['id'] for d in old['departures']])
+    new_trips = set([d['trip']['id'] for d in new['departures']])
+
+    delta = {
+        "added": [d for d in new['departures'] if d['trip']['id'] not in old_trips],
+        "removed": sorted(old_trips - new_trips),
+        "warning_time": new['warning_time'],
+    }
+    if old['routes'] != new['routes']:
+        delta['routes'] = new['routes']
+    return json.dumps(delta)
+
+
+def dashboard_events(dashboard, last_event_id=None, now=None):
+    """
+    A Server-Sent Events response body bringing a client up to date. The
+    event IDs are the ETags from dashboard_json(), so when the client
+    reconnects it tells us which version it has (the Last-Event-ID header)
+    and only gets a 'delta' event with the departures that have been added
+    and removed since. New clients, or ones whose version we've forgotten,
+    get a 'snapshot' with the full JSON.
+
+    Each response is a single update, and the retry field has the client
+    reconnect for the next one, so there's no long-lived connection per
+    client. Deltas are cached, so all the clients of a dashboard share one
+    computation.
+    """
+    etag, content = dashboard_json(dashboard, now)
+    body = "retry: %d\n\n" % (DASHBOARD_EVENTS_RETRY * 1000)
+
+    if last_event_id == etag:
+        return body + ": unchanged\n\n"
+
+    if last_event_id:
+        delta_key = 'traveldash:dashboard-delta:%s:%s' % (last_event_id, etag)
+        delta = cache.get(delta_key)
+        if delta is None:
+            old = cache.get('traveldash:dashboard-content:%s' % last_event_id)
+            if old is not None:
+                delta = _delta(old, content)
+                cache.set(delta_key, delta, DASHBOARD_CACHE_TIMEOUT)
+        if delta is not None:
+            return body + _event(etag, 'delta', delta)
+
+    return body + _event(etag, 'snapshot', content)
@@ -6,18 +6,25 @@ import tempfile
 from datetime import datetime
 import logging
 import time
+import threading
+import Queue
 
 from django.core.management.base import BaseCommand, make_option, CommandError
 from django.db import transaction
 from django.conf import settings
 
 from traveldash.mine.models import GTFSSource, Dashboard
+from traveldash.mine.cache import bump_data_version
+from traveldash.gtfs import timetable
+
+# Longest a single feed download can take (seconds)
+GTFS_DOWNLOAD_TIMEOUT = getattr(settings, 'GTFS_DOWNLOAD_TIMEOUT', 600)
 
 
 class Command(BaseCommand):
     L = logging.getLogger("traveldash.mine.gtfs_update")
 
-    help = "Updates GTFS data. Specify either --all, --auto, --google-fusion-only, or a specific source/zip"
+    help = "Updates GTFS data. Specify either --all, --auto, --google-fusion-only, --departures, or a specific source/zip"
     args = "[SOURCE_ID [ZIP]]"
     option_list = BaseCommand.option_list + (
         make_option('--all',
@@ -32,13 +39,34 @@ class Command(BaseCommand):
             action='store_true',
             default=False,
             help='Update only the Google Fusion Table'),
+        make_option('--departures',
+            action='store_true',
+            default=False,
+            help='Only roll the precomputed departures forward to today (run daily)'),
+        make_option('--full',
+            action='store_true',
+            default=False,
+            help='Truncate & reload all the data for each source, rather than only applying the changes'),
+        make_option('--workers',
+            action='store',
+            type='int',
+            default=1,
+            help='Number of GTFS files to load concurrently (only with --full)'),
+        make_option('--downloads',
+            action='store',
+            type='int',
+            default=4,
+            help='Number of feeds to download at once'),
         )
 
     def handle(self, *args, **options):
-        if (len(args) and (options['all'] or options['auto'] or options['google_fusion'])) \
-                or sum([options['all'], options['auto'], options['google_fusion']]) > 1 \
-                or (sum([options['all'], options['auto'], options['google_fusion']]) == 0 and not len(args)):
+        modes = [options['all'], options['auto'], options['google_fusion'], options['departures']]
+        if (len(args) and any(modes)) \
+                or sum(modes) > 1 \
+                or (sum(modes) == 0 and not len(args)):
             raise CommandError("Invalid combination of options")
+        if options['workers'] > 1 and not options['full']:
+            raise CommandError("--workers needs --full")
 
         # configure logging output
         if options['verbosity'] == '0':
@@ -53,7 +81,11 @@ class Command(BaseCommand):
             self.update_fusion_tables()
             return
 
-        temp_files = []
+        if options['departures']:
+            self.update_departures()
+            # once it's committed
+            bump_data_version()
+            return
 
         sources = []
         qs = None
@@ -84,31 +116,96 @@ class Command(BaseCommand):
                 return
 
         if qs:
-            for source in qs:
-                zip_fd = tempfile.NamedTemporaryFile(suffix='.zip')
-                temp_files.append(zip_fd)
-                source.download_zip(zip_fd)
-                sources.append((source, zip_fd.name))
+            sources = self.download_sources(qs, options['downloads'], conditional=not options['full'])
 
-        self.update_models(sources)
+        loaded = self.update_models(sources, differential=not options['full'], workers=options['workers'])
+        # once it's committed
+        if timetable.GTFS_TIMETABLE_DIR:
+            for source in loaded:
+                self.L.info("Writing timetable for source %s ...", source)
+                timetable.build(source)
+        bump_data_version()
         self.update_fusion_tables()
 
         self.L.info("All done :)")
 
+    def download_sources(self, sources, workers, conditional=True):
+        """
+        Download the sources' ZIP files, up to `workers` at a time. Yields
+        (source, zip path) as each download finishes, so it can be loaded while
+        the rest are still downloading. Sources which fail to download are
+        logged & skipped. The temporary files are removed once the caller
+        moves on to the next one.
+
+        If conditional, sources whose feeds haven't changed since they were
+        last loaded are skipped too, and rescheduled from now.
+        """
+        sources = list(sources)
+        pending = Queue.Queue()
+        for source in sources:
+            pending.put(source)
+        finished = Queue.Queue()
+
+        def download():
+            while True:
+                try:
+                    source = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                # the open ZIP file, False if unchanged or None if it failed
+                result = None
+                zip_fd = None
+                try:
+                    zip_fd = tempfile.NamedTemporaryFile(suffix='.zip')
+                    self.L.info("Downloading source %s ...", source)
+                    if source.download_zip(zip_fd, timeout=GTFS_DOWNLOAD_TIMEOUT, conditional=conditional):
+                        result = zip_fd
+                    else:
+                        result = False
+                except Exception:
+                    self.L.error("Error downloading source %s", source, exc_info=True)
+                finally:
+                    if zip_fd is not None and result is not zip_fd:
+                        zip_fd.close()
+                    # whatever happens, or the loop below waits forever
+                    finished.put((source, result))
+
+        for i in range(min(workers, len(sources))):
+            t = threading.Thread(target=download)
+            t.daemon = True
+            t.start()
+
+        for i in range(len(sources)):
+            source, zip_fd = finished.get()
+            if zip_fd is False:
+                self.L.info("Source %s is unchanged, skipping", source)
+                source.schedule_update(since=datetime.now())
+                source.save()
+            elif zip_fd is not None:
+                try:
+                    yield (source, zip_fd.name)
+                finally:
+                    zip_fd.close()
+
     @transaction.commit_on_success
-    def update_models(self, source_info):
+    def update_models(self, source_info, differential=True, workers=1):
         from traveldash.mine.models import DashboardRoute
         from traveldash.gtfs import load
 
-        self.L.info("Unlinking dashboard stops...")
-        DashboardRoute.objects.unlink_stops()
+        if not differential:
+            self.L.info("Unlinking dashboard stops...")
+            DashboardRoute.objects.unlink_stops()
 
         # do the load
+        loaded = []
         for source, zip_file in source_info:
             self.L.info("Updating source %s from %s ...", source, zip_file)
-            load.load_zip(zip_file, source)
+            load.load_zip(zip_file, source, differential, workers)
             source.last_update = datetime.now()
+            source.schedule_update()
             source.save()
+            loaded.append(source)
 
         self.L.info("Re-linking dashboard stops...")
         errors = DashboardRoute.objects.relink_stops(ignore_errors=True)
@@ -120,6 +217,16 @@ class Command(BaseCommand):
             pk_list = Dashboard.objects.filter(pk__in=unlinked.values_list('dashboard__id')).values_list('pk', flat=True)
             self.L.warning("WARNING: UNLINKED DASHBOARDS: %s", pk_list)
 
+        return loaded
+
+    @transaction.commit_on_success
+    def update_departures(self):
+        from traveldash.gtfs.models import Departure
+
+        for source in GTFSSource.objects.all():
+            self.L.info("Rebuilding departures for source %s ...", source)
+            Departure.gtfs_rebuild(source)
+
     def update_fusion_tables(self):
         from traveldash.gtfs.models import Stop
 
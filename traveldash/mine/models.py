@@ -1,12 +1,47 @@
 from datetime import timedelta, datetime, date
+import re
+import json
+import time
+import heapq
+import random
+import socket
+import hashlib
+import httplib
+import logging
 import urllib2
+from itertools import groupby, islice, takewhile
 
 import lxml.html
+from django.conf import settings
 from django.contrib.gis.db import models
-from django.db.models import Q, Min
-from django.db.models.signals import post_save, pre_save
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_save, post_delete, m2m_changed
 
-from traveldash.gtfs.models import Route, StopTime, Stop, SourceBase
+from traveldash.mine.cache import bump_dashboard_version, bump_data_version, reset_example_dashboards, source_versions
+from traveldash.gtfs.models import Route, Trip, StopTime, Stop, Departure, RouteStopPair, SourceBase
+from traveldash.gtfs import timetable
+
+# Source updates are scheduled up to this fraction of their update_freq late,
+# so sources added together don't all come due at once
+GTFS_UPDATE_JITTER = getattr(settings, 'GTFS_UPDATE_JITTER', 0.1)
+
+# How many times an interrupted feed download is resumed before giving up
+GTFS_DOWNLOAD_RETRIES = getattr(settings, 'GTFS_DOWNLOAD_RETRIES', 3)
+
+# Dashboard.last_viewed is only updated when it's older than this (minutes)
+DASHBOARD_TOUCH_INTERVAL = getattr(settings, 'DASHBOARD_TOUCH_INTERVAL', 10)
+
+# How far ahead of the start time dashboards look for departures (hours)
+DASHBOARD_DEPARTURE_HOURS = getattr(settings, 'DASHBOARD_DEPARTURE_HOURS', 12)
+
+
+def ref_source_id(stop_ref):
+    """ The source id from a 'source_id:stop_id' stop ref, or None if it hasn't got one """
+    match = re.match(r'(\d+):', stop_ref or '')
+    if match is None:
+        return None
+    return int(match.group(1))
 
 
 class CityManager(models.GeoManager):
@@ -39,21 +74,22 @@ class City(models.Model):
 class GTFSSourceManager(models.Manager):
     def need_update(self, updateable=True):
         """
-        Return sources needing an update, based on the update_freq/last_update attributes.
+        Return sources needing an update, most overdue first, based on their
+        next_update_at schedule (see GTFSSource.schedule_update()).
         updateable can be True/False/None to return Updateable/Not-updateable/Both.
         """
         qs = self.get_query_set()
-        qs = qs.extra(where=("(last_update IS NULL) OR (last_update + CAST(textcat(text(update_freq), text(' days')) as interval) <= NOW())",))
+        qs = qs.filter(next_update_at__lte=datetime.now())
         if updateable is True:
             qs = qs.exclude(zip_url='', page_xpath='')
         elif updateable is False:
             qs = qs.filter(zip_url='', page_xpath='')
-        return qs.order_by('?')
+        return qs.order_by('next_update_at')
 
     def updateable(self):
         qs = self.get_query_set()
         qs = qs.exclude(zip_url='', page_xpath='')
-        return qs.order_by('?')
+        return qs.order_by('next_update_at')
 
 
 class GTFSSource(SourceBase):
@@ -67,29 +103,145 @@ class GTFSSource(SourceBase):
 
     last_update = models.DateTimeField(null=True, blank=True)
     update_freq = models.IntegerField('Update frequency', default=14, help_text='How often this feed should be updated (days)')
+    next_update_at = models.DateTimeField(null=True, blank=True, db_index=True, help_text='When this feed is next due to be updated. Leave empty to schedule it from the last update')
+
+    # what we last loaded, so unchanged feeds aren't downloaded & loaded again
+    zip_etag = models.CharField(max_length=200, blank=True, editable=False)
+    zip_last_modified = models.CharField(max_length=64, blank=True, editable=False)
+    zip_sha256 = models.CharField(max_length=64, blank=True, editable=False)
 
     objects = GTFSSourceManager()
 
+    def save(self, *args, **kwargs):
+        if self.next_update_at is None:
+            self.schedule_update()
+        return super(GTFSSource, self).save(*args, **kwargs)
+
+    def schedule_update(self, since=None):
+        """
+        Set next_update_at to update_freq days after the last update (or since,
+        or now if there hasn't been one), plus some jitter.
+        """
+        if since is None:
+            since = self.last_update
+        if since is None:
+            self.next_update_at = datetime.now()
+        else:
+            period = timedelta(days=self.update_freq)
+            jitter = timedelta(seconds=int(random.uniform(0, GTFS_UPDATE_JITTER) * period.days * 86400))
+            self.next_update_at = since + period + jitter
+
+    @property
+    def feed_version(self):
+        """ Identifies the data loaded for this source, see DashboardRoute.get_route_summary() """
+        if self.last_update is None:
+            return ''
+        return self.last_update.strftime('%Y%m%d%H%M%S')
+
     @property
     def can_autoupdate(self):
         return bool(self.zip_url or (self.page_url and self.page_xpath))
 
-    def download_zip(self, fp):
+    def download_zip(self, fp, timeout=None, conditional=True):
         """
         Download the ZIP file into the specified file-like object. If there is no way to
-        auto-download from this source, raises a ValueError.
+        auto-download from this source, raises a ValueError. If it takes longer
+        than timeout seconds, raises an IOError.
+
+        If conditional, the ETag/Last-Modified from the last download are sent
+        along, and False is returned if the server says the file hasn't changed
+        or its content is identical to the last one. Otherwise the new values
+        are set on the source (but not saved, that's up to the caller once the
+        data is loaded) and True is returned.
+
+        Interrupted downloads are resumed from where they got to with Range
+        requests, up to GTFS_DOWNLOAD_RETRIES times.
         """
-        zip_url = self.get_zip_url()
-        zip_req = urllib2.urlopen(zip_url)
-        for chunk in iter(lambda: zip_req.read(64 * 1024), ''):
-            fp.write(chunk)
+        L = logging.getLogger('traveldash.mine.GTFSSource.download_zip')
+
+        start_time = time.time()
+        zip_url = self.get_zip_url(timeout)
+
+        headers = {}
+        if conditional:
+            if self.zip_etag:
+                headers['If-None-Match'] = self.zip_etag
+            if self.zip_last_modified:
+                headers['If-Modified-Since'] = self.zip_last_modified
+
+        sha256 = hashlib.sha256()
+        received = 0
+        total = None
+        etag = last_modified = None
+        retries = 0
+        while True:
+            req = urllib2.Request(zip_url, headers=headers)
+            if received:
+                req.add_header('Range', 'bytes=%d-' % received)
+                # only if it's still the same file
+                if etag or last_modified:
+                    req.add_header('If-Range', etag or last_modified)
+
+            try:
+                zip_req = urllib2.urlopen(req, timeout=timeout)
+            except urllib2.HTTPError, e:
+                if e.code == 304:
+                    L.info("%s hasn't changed", zip_url)
+                    return False
+                raise
+
+            info = zip_req.info()
+            if received and zip_req.getcode() == 206:
+                m = re.match(r'bytes (\d+)-\d+/(\d+)', info.getheader('Content-Range', ''))
+                if not m or int(m.group(1)) != received:
+                    raise IOError("Bad Content-Range resuming %s: %s" % (zip_url, info.getheader('Content-Range')))
+                total = int(m.group(2))
+            else:
+                # from the start
+                if received:
+                    L.info("Server won't resume %s, starting again", zip_url)
+                    fp.seek(0)
+                    fp.truncate()
+                    sha256 = hashlib.sha256()
+                    received = 0
+                total = int(info['Content-Length']) if info.getheader('Content-Length') else None
+                etag = info.getheader('ETag')
+                last_modified = info.getheader('Last-Modified')
+
+            try:
+                for chunk in iter(lambda: zip_req.read(64 * 1024), ''):
+                    fp.write(chunk)
+                    sha256.update(chunk)
+                    received += len(chunk)
+                    if timeout and time.time() - start_time > timeout:
+                        raise IOError("Download of %s took longer than %s seconds" % (zip_url, timeout))
+            except (socket.error, httplib.HTTPException), e:
+                L.warning("Error downloading %s after %d bytes: %s", zip_url, received, e)
+            else:
+                if total is None or received >= total:
+                    break
+                L.warning("Download of %s stopped after %d of %d bytes", zip_url, received, total)
+
+            retries += 1
+            if retries > GTFS_DOWNLOAD_RETRIES:
+                raise IOError("Couldn't download %s, gave up after %d of %s bytes" % (zip_url, received, total))
         fp.flush()
 
-    def get_zip_url(self):
+        digest = sha256.hexdigest()
+        unchanged = conditional and (digest == self.zip_sha256)
+        self.zip_etag = etag or ''
+        self.zip_last_modified = last_modified or ''
+        self.zip_sha256 = digest
+        if unchanged:
+            L.info("%s is the same as last time", zip_url)
+            return False
+        return True
+
+    def get_zip_url(self, timeout=None):
         if self.zip_url:
             return self.zip_url
         elif self.page_url and self.page_xpath:
-            page_doc = lxml.html.parse(self.page_url).getroot()
+            page_doc = lxml.html.parse(urllib2.urlopen(self.page_url, timeout=timeout)).getroot()
             page_doc.make_links_absolute(self.page_url)
             xpath_result = page_doc.xpath(self.page_xpath)
             if len(xpath_result) != 1:
@@ -125,31 +277,30 @@ class Dashboard(models.Model):
         return ('traveldash.mine.views.dashboard_edit', [str(self.pk)])
 
     def next(self, start_time=None, count=10):
+        """
+        Get the next (route, trip, departing, arriving) across all the routes,
+        ordered by when you need to leave to catch them.
+        """
         if start_time is None:
             start_time = datetime.now()
 
-        next = []
-        for route in self.routes.all():
-            for trip, dep, arr in route.next_with_arrivals(start_time, count):
-                next.append((route, trip, dep, arr))
+        return DashboardRoute.objects.next_with_arrivals(start_time, count, dashboard=self)
 
-        return sorted(next, key=lambda x: x[2] - timedelta(minutes=x[0].walk_time_start))[:count]
-
-    def as_json(self):
+    def as_json(self, start_time=None):
         c = {
             "name": self.name,
             "warning_time": self.warning_time,
-            "routes": dict([(route.id, route.as_json()) for route in self.routes.all() if route.has_routes]),
+            "routes": dict([(route.id, route.as_json()) for route in self.routes.select_related('from_stop', 'to_stop') if route.has_routes]),
         }
-        c.update(self.json_update())
+        c.update(self.json_update(start_time))
         return c
 
-    def json_update(self):
+    def json_update(self, start_time=None):
         c = {
             "departures": [],
             "warning_time": self.warning_time,
         }
-        for route, trip, dep, arr in self.next():
+        for route, trip, dep, arr in self.next(start_time):
             c["departures"].append({
                 "route": route.id,
                 "trip": {
@@ -173,69 +324,290 @@ class Dashboard(models.Model):
     def get_alerts(self):
         return Alert.objects.valid(city=self.city)
 
+    @classmethod
+    def signal_changed(cls, sender, instance, **kwargs):
+        bump_dashboard_version(instance.pk)
+
+    @classmethod
+    def signal_deleted(cls, sender, instance, **kwargs):
+        cls.signal_changed(sender, instance, **kwargs)
+        # so the home page doesn't link to it
+        reset_example_dashboards()
+
     def touch(self):
-        self.last_viewed = datetime.now()
-        self.save()
+        """
+        Record that the dashboard's been viewed. last_viewed is only written
+        when it's more than DASHBOARD_TOUCH_INTERVAL minutes old, and then
+        with an UPDATE of just that column which only one of any concurrent
+        requests will match.
+        """
+        now = datetime.now()
+        stale = now - timedelta(minutes=DASHBOARD_TOUCH_INTERVAL)
+        if self.last_viewed is not None and self.last_viewed >= stale:
+            return
+
+        qs = Dashboard.objects.filter(pk=self.pk).filter(Q(last_viewed__isnull=True) | Q(last_viewed__lt=stale))
+        qs.update(last_viewed=now)
+        self.last_viewed = now
 
 
 class DashboardRouteManager(models.Manager):
+    def _sql_format(self):
+        connection = connections[router.db_for_write(DashboardRoute)]
+        qn = connection.ops.quote_name
+        fmt = {
+            'dashboard_route': qn(DashboardRoute._meta.db_table),
+            'routes': qn(DashboardRoute.routes.through._meta.db_table),
+            'stop': qn(Stop._meta.db_table),
+            'route_stop_pair': qn(RouteStopPair._meta.db_table),
+            'route': qn(Route._meta.db_table),
+        }
+        return connection, fmt
+
     def unlink_stops(self):
-        for dr in self.get_query_set():
-            dr.from_stop = None
-            dr.to_stop = None
-            dr.save()
+        """ Clear every DashboardRoute's stops & routes. Their stop refs are kept for relink_stops() """
+        using = router.db_for_write(DashboardRoute)
+        connection, fmt = self._sql_format()
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %(routes)s" % fmt)
+        cursor.execute("UPDATE %(dashboard_route)s SET from_stop_id = NULL, to_stop_id = NULL, route_summary = ''" % fmt)
+        transaction.commit_unless_managed(using=using)
 
     def relink_stops(self, ignore_errors=False):
-        errors = []
-        for dr in self.get_query_set():
-            try:
-                from_stop_ref = dr.from_stop_ref.split(":", 1)
-                dr.from_stop = Stop.objects.get(source__id=int(from_stop_ref[0]), stop_id=from_stop_ref[1])
-            except Stop.DoesNotExist:
-                e = Stop.DoesNotExist("DashboardRoute %s, Can't find Stop with source_id=%s, stop_id=%s" % (dr.pk, from_stop_ref[0], repr(from_stop_ref[1])))
-                if ignore_errors and dr.from_stop_ref:
-                    errors.append(e)
-                else:
-                    raise e
+        """
+        Point every DashboardRoute back at the stops named by its stop refs,
+        and recalculate its routes (and their summaries) from RouteStopPair,
+        in a few set-based queries. Refs which don't match a Stop raise Stop.DoesNotExist before
+        anything changes, or with ignore_errors are returned as a list of them
+        (one per ref) and the rest are relinked.
+        """
+        using = router.db_for_write(DashboardRoute)
+        connection, fmt = self._sql_format()
+        cursor = connection.cursor()
+
+        ends = []
+        for end in ('from', 'to'):
+            end_fmt = dict(fmt, ref='dr.%s_stop_ref' % end, stop_fk='%s_stop_id' % end)
+            # (source_id, stop_id) from 'source_id:stop_id'. The CASE stops
+            # malformed refs failing the cast.
+            end_fmt['ref_source'] = "CASE WHEN %(ref)s ~ '^[0-9]+:' THEN split_part(%(ref)s, ':', 1)::integer END" % end_fmt
+            end_fmt['ref_stop'] = "substr(%(ref)s, strpos(%(ref)s, ':') + 1)" % end_fmt
+            ends.append(end_fmt)
 
-            try:
-                to_stop_ref = dr.to_stop_ref.split(":", 1)
-                dr.to_stop = Stop.objects.get(source__id=int(to_stop_ref[0]), stop_id=to_stop_ref[1])
-            except Stop.DoesNotExist:
-                e = Stop.DoesNotExist("DashboardRoute %s, Can't find Stop with source_id=%s, stop_id=%s" % (dr.pk, to_stop_ref[0], repr(to_stop_ref[1])))
-                if ignore_errors and dr.to_stop_ref:
-                    errors.append(e)
-                else:
-                    raise e
-
-            dr.save()
-            dr.update_routes()
+        errors = []
+        for n, end_fmt in enumerate(ends):
+            cursor.execute("""
+                SELECT dr.id, %(ref)s
+                FROM %(dashboard_route)s dr
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM %(stop)s s
+                    WHERE s.source_id = %(ref_source)s AND s.stop_id = %(ref_stop)s
+                )
+                ORDER BY dr.id
+            """ % end_fmt)
+            for dr_id, ref in cursor.fetchall():
+                if ignore_errors and not ref:
+                    continue
+                ref = ref.split(":", 1) + ['']
+                errors.append((dr_id, n, Stop.DoesNotExist("DashboardRoute %s, Can't find Stop with source_id=%s, stop_id=%s" % (dr_id, ref[0], repr(ref[1])))))
+        # by DashboardRoute, from before to
+        errors = [e for dr_id, n, e in sorted(errors)]
+
+        if errors and not ignore_errors:
+            raise errors[0]
+
+        for end_fmt in ends:
+            cursor.execute("""
+                UPDATE %(dashboard_route)s dr SET %(stop_fk)s = s.id
+                FROM %(stop)s s
+                WHERE s.source_id = %(ref_source)s AND s.stop_id = %(ref_stop)s
+            """ % end_fmt)
+
+        # all the routes serving each pair of stops
+        cursor.execute("DELETE FROM %(routes)s" % fmt)
+        cursor.execute("""
+            INSERT INTO %(routes)s (dashboardroute_id, route_id)
+            SELECT dr.id, p.route_id
+            FROM %(dashboard_route)s dr
+            JOIN %(route_stop_pair)s p ON p.from_stop_id = dr.from_stop_id AND p.to_stop_id = dr.to_stop_id
+        """ % fmt)
+
+        # and their summaries
+        versions = dict([(source.pk, source.feed_version) for source in GTFSSource.objects.all()])
+        cursor.execute("""
+            SELECT dr.id, dr.from_stop_ref, r.id, r.route_type, r.color
+            FROM %(dashboard_route)s dr
+            LEFT JOIN %(routes)s drr ON drr.dashboardroute_id = dr.id
+            LEFT JOIN %(route)s r ON r.id = drr.route_id
+            ORDER BY dr.id
+        """ % fmt)
+        summaries = []
+        for dr_id, rows in groupby(cursor.fetchall(), lambda row: row[0]):
+            rows = list(rows)
+            source_id = ref_source_id(rows[0][1])
+            routes = [row[2:] for row in rows if row[2] is not None]
+            summaries.append((dr_id, DashboardRoute.summarize_routes(routes), versions.get(source_id, '')))
+        for i in range(0, len(summaries), 1000):
+            batch = summaries[i:i + 1000]
+            fmt['values'] = ", ".join(["(%s, %s, %s)"] * len(batch))
+            cursor.execute("""
+                UPDATE %(dashboard_route)s dr SET route_summary = v.summary, route_summary_version = v.version
+                FROM (VALUES %(values)s) AS v (id, summary, version)
+                WHERE dr.id = v.id
+            """ % fmt, [value for summary in batch for value in summary])
+
+        transaction.commit_unless_managed(using=using)
 
         return errors
 
+    def next_with_arrivals(self, start_time, count, dashboard=None, dashboard_route=None):
+        """
+        Get the next (dashboard route, trip, departing, arriving) for all the
+        routes of a dashboard, or for a single route, in one query. Each
+        departure is joined to the trip's next drop-off at the route's
+        to_stop, and the trip comes with its Route already attached. Results
+        are ordered by departure time less the walk to the stop, and stop
+        after count. Only departures within DASHBOARD_DEPARTURE_HOURS of
+        start_time are looked at, so each route's stop is a bounded range of
+        the (stop, departs_at) index however far ahead Departure goes.
+
+        If there are timetables (see traveldash.gtfs.timetable) for all the
+        routes' sources, they're used rather than the database. If the range
+        goes past the days Departure covers, the departures are worked out
+        from the schedule instead.
+        """
+        if timetable.GTFS_TIMETABLE_DIR:
+            next = self._next_from_timetables(start_time, count, dashboard, dashboard_route)
+            if next is not None:
+                return next
+
+        end_time = start_time + timedelta(hours=DASHBOARD_DEPARTURE_HOURS)
+        from_schedule = not Departure.gtfs_covers(end_time)
+        return self._next_with_arrivals(start_time, count, dashboard, dashboard_route, from_schedule=from_schedule)
+
+    def _next_with_arrivals(self, start_time, count, dashboard=None, dashboard_route=None, from_schedule=False):
+        connection = connections[router.db_for_read(Departure)]
+        qn = connection.ops.quote_name
+        models = (DashboardRoute, Trip, Route)
+        fields = [m._meta.fields for m in models]
+        fmt = {
+            'departure': qn(Departure._meta.db_table),
+            'stop_time': qn(StopTime._meta.db_table),
+            'trip': qn(Trip._meta.db_table),
+            'route': qn(Route._meta.db_table),
+            'dashboard_route': qn(DashboardRoute._meta.db_table),
+            'routes': qn(DashboardRoute.routes.through._meta.db_table),
+            'columns': ", ".join(["%s.%s" % (alias, qn(f.column)) for alias, model_fields in zip(('dr', 't', 'r'), fields) for f in model_fields]),
+            'dropoff': StopTime.DROPOFF,
+        }
+        end_time = start_time + timedelta(hours=DASHBOARD_DEPARTURE_HOURS)
+        params = []
+        if from_schedule:
+            fmt['departure'] = "(%s)" % Departure.gtfs_schedule_sql(connection)
+            # yesterday's service runs past midnight
+            params += [start_time.date() - timedelta(days=1), end_time.date()]
+        if dashboard_route is not None:
+            fmt['where'] = "dr.id = %s"
+            params.append(dashboard_route.pk)
+        else:
+            fmt['where'] = "dr.dashboard_id = %s"
+            params.append(dashboard.pk)
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT d.departs_at, d.service_date, arr.arrival_time, arr.arrival_days, %(columns)s
+            FROM %(dashboard_route)s dr
+            JOIN %(departure)s d ON d.stop_id = dr.from_stop_id
+            JOIN %(routes)s drr ON drr.dashboardroute_id = dr.id AND drr.route_id = d.route_id
+            JOIN %(stop_time)s dep ON dep.id = d.stop_time_id
+            JOIN %(stop_time)s arr ON arr.trip_id = d.trip_id
+                AND arr.stop_sequence = (
+                    SELECT MIN(a.stop_sequence) FROM %(stop_time)s a
+                    WHERE a.trip_id = d.trip_id AND a.stop_id = dr.to_stop_id
+                        AND a.drop_off_type = %(dropoff)d AND a.stop_sequence > dep.stop_sequence
+                )
+            JOIN %(trip)s t ON t.id = d.trip_id
+            JOIN %(route)s r ON r.id = d.route_id
+            WHERE %(where)s AND d.departs_at >= %%s AND d.departs_at < %%s
+            ORDER BY d.departs_at - dr.walk_time_start * interval '1 minute', d.departs_at
+            LIMIT %%s
+        """ % fmt, params + [start_time, end_time, count])
+
+        route_cache = Trip._meta.get_field('route').get_cache_name()
+        next = []
+        for row in cursor.fetchall():
+            departs_at, service_date, arrival_time, arrival_days = row[:4]
+            instances = []
+            i = 4
+            for model, model_fields in zip(models, fields):
+                instances.append(model(*row[i:i + len(model_fields)]))
+                i += len(model_fields)
+            dr, trip, route = instances
+            setattr(trip, route_cache, route)
+            arr = StopTime(arrival_time=arrival_time, arrival_days=arrival_days).arriving(service_date)
+            next.append((dr, trip, departs_at, arr))
+        return next
+
+    def _next_from_timetables(self, start_time, count, dashboard=None, dashboard_route=None):
+        """ next_with_arrivals() from the timetables, or None if any are missing """
+        if dashboard_route is not None:
+            dashboard_routes = [dashboard_route]
+        else:
+            dashboard_routes = list(dashboard.routes.all())
+
+        route_ids = dict([(dr.pk, set(dr.get_route_summary()['ids'])) for dr in dashboard_routes])
+        end_time = start_time + timedelta(hours=DASHBOARD_DEPARTURE_HOURS)
+
+        streams = []
+        timetables = []
+        for n, dr in enumerate(dashboard_routes):
+            if not (dr.from_stop_id and dr.to_stop_id and route_ids[dr.pk]):
+                timetables.append(None)
+                continue
+            tt = timetable.get(dr.ref_source_id)
+            if tt is None:
+                return None
+            timetables.append(tt)
+            walk_time = timedelta(minutes=dr.walk_time_start)
+            departures = takewhile(lambda d: d[0] < end_time, tt.departures(dr.from_stop_id, start_time, route_ids[dr.pk], dr.to_stop_id))
+            # ordered by when you need to leave, then as per the query
+            streams.append(((dep - walk_time, dep, n, trip, arr) for dep, service_date, trip, arr in departures))
+
+        next = []
+        for leave, dep, n, trip, arr in islice(heapq.merge(*streams), count):
+            next.append((dashboard_routes[n], timetables[n].trip(trip), dep, arr))
+        return next
+
     def unlinked_stops(self):
         return self.get_query_set().filter(Q(from_stop_ref='') | Q(to_stop_ref=''))
 
     def no_routes(self):
-        pk_list = []
-        for dr in self.get_query_set():
-            if not Route.objects.between_stops(dr.from_stop, dr.to_stop).exists():
-                pk_list.append(dr.pk)
-        return self.get_query_set().filter(pk__in=pk_list)
+        """ The DashboardRoutes which no route runs between the stops of """
+        qn = connections[router.db_for_read(RouteStopPair)].ops.quote_name
+        return self.get_query_set().extra(where=["""
+            NOT EXISTS (
+                SELECT 1 FROM %(route_stop_pair)s p
+                WHERE p.from_stop_id = %(dashboard_route)s.from_stop_id AND p.to_stop_id = %(dashboard_route)s.to_stop_id
+            )
+        """ % {'route_stop_pair': qn(RouteStopPair._meta.db_table), 'dashboard_route': qn(DashboardRoute._meta.db_table)}])
 
 
 class DashboardRoute(models.Model):
     dashboard = models.ForeignKey(Dashboard, related_name='routes')
     name = models.CharField(max_length=50, blank=True)
     from_stop_ref = models.CharField(help_text='SourceID:stop_id from the GTFS Feed', max_length=50, editable=False, blank=True)
-    from_stop = models.ForeignKey('gtfs.Stop', verbose_name='Which stop do you leave from?', related_name='dashboard_routes_start', null=True)
+    from_stop = models.ForeignKey('gtfs.Stop', verbose_name='Which stop do you leave from?', related_name='dashboard_routes_start', null=True, on_delete=models.SET_NULL)
     to_stop_ref = models.CharField(help_text='SourceID:stop_id from the GTFS Feed', max_length=50, editable=False, blank=True)
-    to_stop = models.ForeignKey('gtfs.Stop', verbose_name='Which stop do you go to?', related_name='dashboard_routes_end', null=True)
+    to_stop = models.ForeignKey('gtfs.Stop', verbose_name='Which stop do you go to?', related_name='dashboard_routes_end', null=True, on_delete=models.SET_NULL)
     routes = models.ManyToManyField('gtfs.Route')
     walk_time_start = models.PositiveIntegerField('How long to walk there?', default=0, help_text='minutes')
     walk_time_end = models.PositiveIntegerField('How long to walk from there?', default=0, help_text='minutes')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # JSON summary of the routes, see get_route_summary()
+    route_summary = models.TextField(blank=True, editable=False)
+    route_summary_version = models.CharField(max_length=20, blank=True, editable=False)
+
     objects = DashboardRouteManager()
 
     def __unicode__(self):
@@ -249,6 +621,77 @@ class DashboardRoute(models.Model):
     def signal_update_routes(cls, sender, instance, **kwargs):
         instance.update_routes()
 
+    @classmethod
+    def signal_changed(cls, sender, instance, **kwargs):
+        bump_dashboard_version(instance.dashboard_id)
+
+    @classmethod
+    def signal_routes_changed(cls, sender, instance, action, reverse, model, pk_set, **kwargs):
+        """
+        Keep the route summaries & dashboard versions up to date when routes
+        are changed from either side. When it's from the Route's side (eg.
+        route.dashboardroute_set.add()), instance is the Route and pk_set has
+        the DashboardRoutes.
+        """
+        if reverse and action == 'pre_clear':
+            # clears don't say which DashboardRoutes they're clearing
+            instance._cleared_dashboard_routes = list(model.objects.filter(routes=instance))
+            return
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+
+        if not reverse:
+            dashboard_routes = [instance]
+        elif action == 'post_clear':
+            dashboard_routes = instance.__dict__.pop('_cleared_dashboard_routes', [])
+        else:
+            dashboard_routes = model.objects.filter(pk__in=pk_set)
+
+        for dr in dashboard_routes:
+            dr.save_route_summary()
+            bump_dashboard_version(dr.dashboard_id)
+
+    @property
+    def ref_source_id(self):
+        """ The source id from from_stop_ref """
+        return ref_source_id(self.from_stop_ref)
+
+    @classmethod
+    def summarize_routes(cls, routes):
+        """ The JSON route summary for a list of (id, route_type, color) """
+        routes = sorted(routes)
+        colors = []
+        for route_id, route_type, color in routes:
+            if color and color not in colors:
+                colors.append(color)
+        return json.dumps({
+            "ids": [r[0] for r in routes],
+            "count": len(routes),
+            "modes": sorted(set([r[1] for r in routes])),
+            "colors": colors,
+        })
+
+    def get_route_summary(self):
+        """
+        The ids, count, modes & colours of the routes, as a dict. Kept with
+        the DashboardRoute by save_route_summary() & relink_stops(), so it
+        doesn't need querying. It's ignored (and the routes are queried) if
+        the source's been reloaded since.
+        """
+        if not hasattr(self, '_route_summary'):
+            if self.route_summary and self.route_summary_version == source_versions().get(self.ref_source_id, ''):
+                self._route_summary = json.loads(self.route_summary)
+            else:
+                self._route_summary = json.loads(self.summarize_routes(self.routes.values_list('id', 'route_type', 'color')))
+        return self._route_summary
+
+    def save_route_summary(self):
+        """ Recalculate & save the route summary. Doesn't fire any signals """
+        self.route_summary = self.summarize_routes(self.routes.values_list('id', 'route_type', 'color'))
+        self.route_summary_version = source_versions().get(self.ref_source_id, '')
+        DashboardRoute.objects.filter(pk=self.pk).update(route_summary=self.route_summary, route_summary_version=self.route_summary_version)
+        self._route_summary = json.loads(self.route_summary)
+
     def update_stops(self):
         if self.from_stop:
             self.from_stop_ref = "%s:%s" % (self.from_stop.source_id, self.from_stop.stop_id)
@@ -267,32 +710,50 @@ class DashboardRoute(models.Model):
         if start_time is None:
             start_time = datetime.now()
 
-        today = start_time.date()
-        tomorrow = today + timedelta(days=1)
-        dt = start_time.time()
-        dt_int = dt.hour * 3600 + dt.minute * 60 + dt.second
-
-        qs = StopTime.objects.filter(trip__route__in=self.routes.all(), stop=self.from_stop, pickup_type=StopTime.PICKUP)
-        qs = qs.filter(Q(trip__service__all_dates__date=today, departure_time__gte=dt_int)
-                       | Q(trip__service__all_dates__date=tomorrow))
-        qs = qs.select_related('trip').annotate(service_date=Min('trip__service__all_dates__date'))
-        qs = qs.order_by('trip__service__all_dates__date', 'departure_days', 'departure_time')[:count]
+        tt = timetable.get(self.ref_source_id) if self.from_stop_ref else None
+        if tt is not None:
+            route_ids = set(self.get_route_summary()['ids'])
+            for departing, service_date, trip, arriving in islice(tt.departures(self.from_stop_id, start_time, route_ids), count):
+                yield (tt.trip(trip), departing, service_date)
+            return
 
-        for stop_time in qs:
-            yield (stop_time.trip, stop_time.departing(stop_time.service_date), stop_time.service_date)
+        if Departure.gtfs_covers(start_time + timedelta(hours=DASHBOARD_DEPARTURE_HOURS)):
+            qs = Departure.objects.filter(stop=self.from_stop, route__in=self.routes.all(), departs_at__gte=start_time)
+            departures = list(qs.select_related('trip').order_by('departs_at')[:count])
+        else:
+            # past the end of Departure, work them out from the schedule
+            connection = connections[router.db_for_read(Departure)]
+            qn = connection.ops.quote_name
+            fmt = {
+                'schedule': Departure.gtfs_schedule_sql(connection),
+                'routes': qn(DashboardRoute.routes.through._meta.db_table),
+            }
+            departures = list(Departure.objects.raw("""
+                SELECT d.stop_time_id AS id, d.*
+                FROM (%(schedule)s) AS d
+                JOIN %(routes)s drr ON drr.route_id = d.route_id
+                WHERE drr.dashboardroute_id = %%s AND d.stop_id = %%s AND d.departs_at >= %%s
+                ORDER BY d.departs_at
+                LIMIT %%s
+            """ % fmt, list(Departure.gtfs_window(start_time.date())) + [self.pk, self.from_stop_id, start_time, count]))
+            trips = Trip.objects.in_bulk([d.trip_id for d in departures])
+            for departure in departures:
+                setattr(departure, Departure._meta.get_field('trip').get_cache_name(), trips[departure.trip_id])
+
+        for departure in departures:
+            yield (departure.trip, departure.departs_at, departure.service_date)
 
     def next_with_arrivals(self, start_time=None, count=10):
+        """ Get the next (trip, departing, arriving) for this route, in a single query """
         if start_time is None:
             start_time = datetime.now()
 
-        for trip, departing, service_date in self.next(start_time, count):
-            arr_st = trip.stop_times.filter(stop=self.to_stop, drop_off_type=StopTime.DROPOFF)[0]
-            arr = arr_st.arriving(service_date)
-            yield (trip, departing, arr)
+        for dr, trip, departing, arriving in DashboardRoute.objects.next_with_arrivals(start_time, count, dashboard_route=self):
+            yield (trip, departing, arriving)
 
     @property
     def has_routes(self):
-        return bool(self.routes.count())
+        return bool(self.get_route_summary()['count'])
 
     def as_json(self):
         c = {
@@ -307,11 +768,18 @@ class DashboardRoute(models.Model):
                 "name": self.to_stop.name,
                 "walk_time": self.walk_time_end,
             },
+            "modes": self.get_route_summary()['modes'],
+            "colors": self.get_route_summary()['colors'],
         }
         return c
 
 pre_save.connect(DashboardRoute.signal_update_stops, sender=DashboardRoute)
 post_save.connect(DashboardRoute.signal_update_routes, sender=DashboardRoute)
+post_save.connect(DashboardRoute.signal_changed, sender=DashboardRoute)
+post_delete.connect(DashboardRoute.signal_changed, sender=DashboardRoute)
+m2m_changed.connect(DashboardRoute.signal_routes_changed, sender=DashboardRoute.routes.through)
+post_save.connect(Dashboard.signal_changed, sender=Dashboard)
+post_delete.connect(Dashboard.signal_deleted, sender=Dashboard)
 
 
 class AlertManager(models.Manager):
@@ -337,3 +805,10 @@ class Alert(models.Model):
     def is_valid(self):
         return (self.valid_from <= date.today()) \
             and ((self.valid_to is None) or (self.valid_to >= date.today()))
+
+    @classmethod
+    def signal_changed(cls, sender, instance, **kwargs):
+        bump_data_version()
+
+post_save.connect(Alert.signal_changed, sender=Alert)
+post_delete.connect(Alert.signal_changed, sender=Alert)
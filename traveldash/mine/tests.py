@@ -5,8 +5,44 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import BaseHTTPServer
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.test import TestCase
 
+from traveldash.gtfs.models import Agency, Stop, Service, Route, Trip, StopTime, Departure, UniversalCalendar, RouteStopPair
+from traveldash.gtfs import timetable
+from traveldash.mine.models import City, GTFSSource, Dashboard, DashboardRoute, DASHBOARD_DEPARTURE_HOURS, GTFS_UPDATE_JITTER
+from traveldash.mine.cache import bump_data_version, dashboard_version, example_dashboard_id, dashboard_json, dashboard_events, EXAMPLE_DASHBOARDS_KEY, DASHBOARD_EVENTS_RETRY
+
+
+class QueryCounter(object):
+    """ Counts the queries run in a with block, for when assertNumQueries() is too exact """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+
+    def __enter__(self):
+        self.old_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.start = len(self.connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.use_debug_cursor = self.old_debug_cursor
+        self.count = len(self.connection.queries) - self.start
+        self.sql = [q['sql'] for q in self.connection.queries[self.start:]]
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -15,6 +51,429 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+
+class DashboardDepartureTest(TestCase):
+    ROUTES = 5
+    TRIPS = 10
+
+    def setUp(self):
+        city = City.objects.create(name='Testville', country='nz', map_center=Point(174.76, -36.85))
+        user = User.objects.create_user('test', 'test@example.com', 'test')
+        self.source = source = GTFSSource.objects.create(name='Test', city=city)
+        agency = Agency.objects.create(source=source, agency_id='A', name='Test Agency', url='http://example.com/', timezone='Pacific/Auckland', lang='en', phone='')
+        self.service = service = Service.objects.create(source=source, service_id='WEEKDAY')
+        self.from_stop, self.to_stop = from_stop, to_stop = [Stop.objects.create(source=source, stop_id='S%d' % i, code='', name='Stop %d' % i, desc='', url='', location=Point(174.76, -36.85 + i * 0.01)) for i in range(2)]
+
+        self.start_time = datetime(2012, 1, 2, 8, 0)
+        self.dashboard = Dashboard.objects.create(user=user, city=city, name='Test')
+        for n in range(self.ROUTES):
+            route = Route.objects.create(agency=agency, route_id='R%d' % n, short_name=str(n), long_name='Route %d' % n, route_type=Route.BUS)
+            for i in range(self.TRIPS):
+                trip = Trip.objects.create(route=route, service=service, trip_id='T%d-%d' % (n, i), headsign='', short_name='')
+                departs = 8 * 3600 + (i * self.ROUTES + n) * 60
+                dep = StopTime.objects.create(trip=trip, stop=from_stop, stop_sequence=1, stop_headsign='',
+                                              arrival_time=departs, arrival_days=0, departure_time=departs, departure_days=0)
+                StopTime.objects.create(trip=trip, stop=to_stop, stop_sequence=2, stop_headsign='',
+                                        arrival_time=departs + 600, arrival_days=0, departure_time=departs + 600, departure_days=0)
+                Departure.objects.create(stop=from_stop, route=route, trip=trip, stop_time=dep,
+                                         service_date=self.start_time.date(), departs_at=self.start_time + timedelta(seconds=departs - 8 * 3600))
+
+            dr = DashboardRoute.objects.create(dashboard=self.dashboard, name='Route %d' % n, from_stop=from_stop, to_stop=to_stop)
+            dr.routes = [route]
+
+    def test_next_with_arrivals(self):
+        route = self.dashboard.routes.get(name='Route 0')
+        with self.assertNumQueries(1):
+            next = list(route.next_with_arrivals(self.start_time, 3))
+            # the routes come along with the trips
+            [trip.route.short_name for trip, dep, arr in next]
+
+        self.assertEqual(len(next), 3)
+        for trip, dep, arr in next:
+            self.assertEqual(trip.route.short_name, '0')
+            self.assertEqual(arr - dep, timedelta(minutes=10))
+        self.assertEqual([dep for trip, dep, arr in next], sorted([dep for trip, dep, arr in next]))
+
+    def test_departure_horizon(self):
+        route = self.dashboard.routes.get(name='Route 0')
+        trip = Trip.objects.get(trip_id='T0-0')
+        # after the last of setUp's departures
+        start_time = self.start_time + timedelta(hours=1)
+        later = start_time + timedelta(hours=DASHBOARD_DEPARTURE_HOURS, minutes=30)
+        Departure.objects.create(stop=self.from_stop, route=trip.route, trip=trip, stop_time=trip.stop_times.get(stop_sequence=1),
+                                 service_date=later.date(), departs_at=later)
+
+        self.assertEqual(list(route.next_with_arrivals(start_time, 1)), [])
+        self.assertEqual([dep for trip, dep, arr in route.next_with_arrivals(later - timedelta(hours=1), 1)], [later])
+
+    def test_short_departures(self):
+        # fewer than asked for, but within the days Departure covers
+        route = self.dashboard.routes.get(name='Route 0')
+        calendar = UniversalCalendar._meta.db_table
+        with QueryCounter() as queries:
+            next = list(route.next_with_arrivals(self.start_time, self.TRIPS * 2))
+        self.assertEqual(len(next), self.TRIPS)
+        self.assertEqual(queries.count, 1)
+        self.assertFalse([sql for sql in queries.sql if calendar in sql])
+
+        with QueryCounter() as queries:
+            next = list(route.next(self.start_time, self.TRIPS * 2))
+        self.assertEqual(len(next), self.TRIPS)
+        self.assertFalse([sql for sql in queries.sql if calendar in sql])
+
+    def test_json_update_queries(self):
+        # all the routes are merged in the one query
+        with self.assertNumQueries(1):
+            c = self.dashboard.json_update()
+
+        self.assertEqual(len(c['departures']), 10)
+        self.assertEqual([d['trip']['short_name'] for d in c['departures'][:self.ROUTES]], [str(n) for n in range(self.ROUTES)])
+
+    def test_walk_time(self):
+        # you need to leave 20 minutes before route 4's departures to catch them
+        dr = self.dashboard.routes.get(name='Route 4')
+        dr.walk_time_start = 20
+        dr.save()
+        dr.routes = Route.objects.filter(route_id='R4')
+
+        next = self.dashboard.next(self.start_time, 5)
+        self.assertEqual([route.name for route, trip, dep, arr in next], ['Route 4'] * 4 + ['Route 0'])
+
+    def test_between_stops(self):
+        RouteStopPair.gtfs_rebuild(self.source)
+        self.assertEqual(Route.objects.between_stops(self.from_stop, self.to_stop).count(), self.ROUTES)
+        self.assertEqual(Trip.objects.between_stops(self.from_stop, self.to_stop).count(), self.ROUTES * self.TRIPS)
+        # not the wrong way
+        self.assertFalse(Route.objects.between_stops(self.to_stop, self.from_stop).exists())
+        self.assertFalse(Trip.objects.between_stops(self.to_stop, self.from_stop).exists())
+
+        dr = self.dashboard.routes.get(name='Route 0')
+        self.assertEqual(list(DashboardRoute.objects.no_routes()), [])
+        dr.from_stop, dr.to_stop = self.to_stop, self.from_stop
+        dr.save()
+        self.assertEqual(list(DashboardRoute.objects.no_routes()), [dr])
+        self.assertEqual(dr.routes.count(), 0)
+
+    def test_ref_source_id(self):
+        dr = self.dashboard.routes.get(name='Route 0')
+        self.assertEqual(dr.ref_source_id, self.source.pk)
+        for ref in ('', 'S0', 'None:S0', 'x1:S0', ':S0'):
+            dr.from_stop_ref = ref
+            self.assertEqual(dr.ref_source_id, None)
+
+    def test_relink_stops(self):
+        RouteStopPair.gtfs_rebuild(self.source)
+        DashboardRoute.objects.unlink_stops()
+        self.assertEqual(DashboardRoute.objects.filter(from_stop__isnull=False).count(), 0)
+        self.assertEqual(DashboardRoute.routes.through.objects.count(), 0)
+
+        bad = self.dashboard.routes.get(name='Route 2')
+        DashboardRoute.objects.filter(pk=bad.pk).update(to_stop_ref='%s:NOPE' % self.source.pk)
+        self.assertRaises(Stop.DoesNotExist, DashboardRoute.objects.relink_stops)
+
+        # a fixed number of queries, however many DashboardRoutes there are
+        with QueryCounter() as queries:
+            errors = DashboardRoute.objects.relink_stops(ignore_errors=True)
+        self.assertTrue(queries.count <= 10, "%d queries" % queries.count)
+        self.assertEqual([str(e) for e in errors], ["DashboardRoute %s, Can't find Stop with source_id=%s, stop_id=u'NOPE'" % (bad.pk, self.source.pk)])
+
+        for dr in self.dashboard.routes.all():
+            self.assertEqual(dr.from_stop, self.from_stop)
+            if dr.pk == bad.pk:
+                self.assertEqual(dr.to_stop, None)
+                self.assertEqual(dr.routes.count(), 0)
+                self.assertEqual(dr.get_route_summary()['count'], 0)
+            else:
+                self.assertEqual(dr.to_stop, self.to_stop)
+                # every route runs between them
+                self.assertEqual(dr.routes.count(), self.ROUTES)
+                self.assertEqual(dr.get_route_summary()['ids'], sorted(dr.routes.values_list('pk', flat=True)))
+
+    def test_routes_changed_from_route(self):
+        dr = self.dashboard.routes.get(name='Route 0')
+        route = Route.objects.get(route_id='R1')
+        version = dashboard_version(self.dashboard.pk)
+
+        route.dashboardroute_set.add(dr)
+        dr = DashboardRoute.objects.get(pk=dr.pk)
+        self.assertEqual(dr.get_route_summary()['ids'], sorted(dr.routes.values_list('pk', flat=True)))
+        self.assertEqual(dr.get_route_summary()['count'], 2)
+        self.assertNotEqual(dashboard_version(self.dashboard.pk), version)
+
+        # from both the DashboardRoutes it was on
+        route.dashboardroute_set.clear()
+        self.assertEqual(DashboardRoute.objects.get(pk=dr.pk).get_route_summary()['count'], 1)
+        self.assertEqual(self.dashboard.routes.get(name='Route 1').get_route_summary()['count'], 0)
+
+    def test_example_dashboard(self):
+        cache.delete(EXAMPLE_DASHBOARDS_KEY)
+        Dashboard.objects.create(user=self.dashboard.user, city=self.dashboard.city, name='No routes')
+        self.assertEqual(example_dashboard_id(), self.dashboard.pk)
+
+        # the pool's kept while dashboards are edited
+        self.dashboard.routes.get(name='Route 0').delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(example_dashboard_id(), self.dashboard.pk)
+
+        self.dashboard.delete()
+        self.assertEqual(example_dashboard_id(), None)
+
+    def test_as_json_queries(self):
+        # the versions of the sources get cached
+        self.dashboard.as_json(self.start_time)
+
+        # just the dashboard routes & the departures, not their routes
+        with self.assertNumQueries(2):
+            c = self.dashboard.as_json(self.start_time)
+        self.assertEqual(len(c['routes']), self.ROUTES)
+        self.assertEqual(c['routes'].values()[0]['modes'], [Route.BUS])
+
+        # a reload of the source makes them stale
+        self.source.last_update = datetime.now()
+        self.source.save()
+        bump_data_version()
+        dr = self.dashboard.routes.all()[0]
+        with self.assertNumQueries(2):
+            self.assertTrue(dr.has_routes)
+
+    def test_json_cache(self):
+        entry = dashboard_json(self.dashboard, self.start_time + timedelta(seconds=10))
+        # later in the same minute
+        with self.assertNumQueries(0):
+            self.assertEqual(dashboard_json(self.dashboard, self.start_time + timedelta(seconds=50)), entry)
+
+        # new data
+        bump_data_version()
+        with QueryCounter() as queries:
+            self.assertEqual(dashboard_json(self.dashboard, self.start_time + timedelta(seconds=50)), entry)
+        self.assertTrue(queries.count > 0)
+
+        # the next minute
+        etag, content = dashboard_json(self.dashboard, self.start_time + timedelta(minutes=1))
+        self.assertNotEqual(etag, entry[0])
+
+    def test_events(self):
+        def events(body):
+            return re.findall(r'^id: (\w+)\nevent: (\w+)\ndata: (.*)$', body, re.M)
+
+        # new clients get the lot
+        etag, content = dashboard_json(self.dashboard, self.start_time)
+        body = dashboard_events(self.dashboard, now=self.start_time)
+        self.assertTrue(body.startswith('retry: %d\n\n' % (DASHBOARD_EVENTS_RETRY * 1000)))
+        self.assertEqual(events(body), [(etag, 'snapshot', content)])
+
+        body = dashboard_events(self.dashboard, etag, now=self.start_time)
+        self.assertEqual(events(body), [])
+        self.assertTrue(body.endswith(': unchanged\n\n'))
+
+        # the first departures have gone, and later ones come in
+        later = self.start_time + timedelta(minutes=5)
+        new_etag, new_content = dashboard_json(self.dashboard, later)
+        [(event_id, event, data)] = events(dashboard_events(self.dashboard, etag, now=later))
+        self.assertEqual((event_id, event), (new_etag, 'delta'))
+        delta = json.loads(data)
+        old_trips = set([d['trip']['id'] for d in json.loads(content)['departures']])
+        new_departures = json.loads(new_content)['departures']
+        self.assertEqual(len(delta['removed']), 5)
+        self.assertEqual(delta['removed'], sorted(old_trips - set([d['trip']['id'] for d in new_departures])))
+        self.assertEqual(len(delta['added']), 5)
+        self.assertEqual(delta['added'], [d for d in new_departures if d['trip']['id'] not in old_trips])
+        self.assertFalse('routes' in delta)
+
+        # a version we've forgotten
+        cache.delete('traveldash:dashboard-content:%s' % etag)
+        later += timedelta(minutes=1)
+        newest_etag, newest_content = dashboard_json(self.dashboard, later)
+        self.assertEqual(events(dashboard_events(self.dashboard, etag, now=later)), [(newest_etag, 'snapshot', newest_content)])
+
+    def test_update_etag(self):
+        url = reverse('traveldash.mine.views.dashboard_update', args=[str(self.dashboard.pk)])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['ETag'], etag)
+
+        # edited since
+        self.dashboard.name = 'Renamed'
+        self.dashboard.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)['name'], 'Renamed')
+
+    def test_timetable(self):
+        UniversalCalendar.objects.create(service=self.service, date=self.start_time.date())
+        dr = self.dashboard.routes.get(name='Route 4')
+        dr.walk_time_start = 20
+        dr.save()
+        dr.routes = Route.objects.filter(route_id='R4')
+        start_time = self.start_time + timedelta(minutes=7)
+
+        def next():
+            return [(dr.pk, trip.pk, trip.route.short_name, dep, arr) for dr, trip, dep, arr in self.dashboard.next(start_time, 8)]
+
+        from_db = next()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            timetable.GTFS_TIMETABLE_DIR = tmpdir
+            timetable.build(self.source)
+            self.assertEqual(next(), from_db)
+            self.assertEqual([d for trip, d, service_date in dr.next(start_time, 3)],
+                             [d.departs_at for d in Departure.objects.filter(trip__route__route_id='R4', departs_at__gte=start_time)[:3]])
+        finally:
+            timetable.GTFS_TIMETABLE_DIR = None
+            for tt in timetable._timetables.values():
+                tt.close()
+            timetable._timetables.clear()
+            shutil.rmtree(tmpdir)
+
+
+class GTFSSourceScheduleTest(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(name='Testville', country='nz', map_center=Point(174.76, -36.85))
+
+    def test_schedule_update(self):
+        last_update = datetime(2012, 1, 2, 3, 4, 5)
+        source = GTFSSource(name='Test', city=self.city, last_update=last_update, update_freq=10)
+        scheduled = set()
+        for i in range(20):
+            source.schedule_update()
+            self.assertTrue(last_update + timedelta(days=10) <= source.next_update_at <= last_update + timedelta(days=10 * (1 + GTFS_UPDATE_JITTER)))
+            scheduled.add(source.next_update_at)
+        # spread out, so sources loaded together aren't all due together
+        self.assertTrue(len(scheduled) > 1)
+
+        since = datetime(2012, 2, 1)
+        source.schedule_update(since)
+        self.assertTrue(since + timedelta(days=10) <= source.next_update_at <= since + timedelta(days=10 * (1 + GTFS_UPDATE_JITTER)))
+
+        # never loaded, so due straight away
+        before = datetime.now()
+        source = GTFSSource.objects.create(name='New', city=self.city)
+        self.assertTrue(before <= source.next_update_at <= datetime.now())
+
+    def test_need_update(self):
+        now = datetime.now()
+
+        def create(name, next_update_at, **kwargs):
+            return GTFSSource.objects.create(name=name, city=self.city, next_update_at=next_update_at, **kwargs)
+
+        overdue = create('Overdue', now - timedelta(days=2), zip_url='http://example.com/overdue.zip')
+        due = create('Due', now - timedelta(hours=1), page_url='http://example.com/', page_xpath='//a/@href')
+        create('Later', now + timedelta(days=1), zip_url='http://example.com/later.zip')
+        manual = create('Manual', now - timedelta(days=1))
+
+        self.assertEqual(list(GTFSSource.objects.need_update()), [overdue, due])
+        self.assertEqual(list(GTFSSource.objects.need_update(updateable=False)), [manual])
+        self.assertEqual(list(GTFSSource.objects.need_update(updateable=None)), [overdue, manual, due])
+
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves server.content, with an ETag, 304s & Range requests """
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if m and self.headers.get('If-Range', server.etag) == server.etag:
+            start = int(m.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(server.content) - 1, len(server.content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', len(server.content) - start)
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+
+        body = server.content[start:]
+        if server.drop_after:
+            # hang up part way through
+            body = body[:server.drop_after]
+            server.drop_after = None
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FeedDownloadTest(TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FeedHandler)
+        self.server.content = 'PK' + 'x' * 100000
+        self.server.etag = '"v1"'
+        self.server.drop_after = None
+        self.server.requests = []
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+        city = City.objects.create(name='Testville', country='nz', map_center=Point(174.76, -36.85))
+        self.source = GTFSSource.objects.create(name='Test', city=city, zip_url='http://127.0.0.1:%d/feed.zip' % self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def download(self, **kwargs):
+        with tempfile.TemporaryFile() as fp:
+            changed = self.source.download_zip(fp, timeout=10, **kwargs)
+            fp.seek(0)
+            return changed, fp.read()
+
+    def test_download(self):
+        changed, content = self.download()
+        self.assertTrue(changed)
+        self.assertEqual(content, self.server.content)
+        self.assertEqual(self.source.zip_etag, '"v1"')
+        self.assertEqual(self.source.zip_sha256, hashlib.sha256(self.server.content).hexdigest())
+
+    def test_not_modified(self):
+        self.download()
+        changed, content = self.download()
+        self.assertFalse(changed)
+        self.assertEqual(content, '')
+        self.assertEqual(self.server.requests[-1]['if-none-match'], '"v1"')
+
+        # unless we want it anyway
+        changed, content = self.download(conditional=False)
+        self.assertTrue(changed)
+        self.assertEqual(content, self.server.content)
+
+    def test_same_content(self):
+        self.download()
+        # republished, but the bytes are the same
+        self.server.etag = '"v2"'
+        changed, content = self.download()
+        self.assertFalse(changed)
+        self.assertEqual(self.source.zip_etag, '"v2"')
+
+        self.server.etag = '"v3"'
+        self.server.content += 'y'
+        changed, content = self.download()
+        self.assertTrue(changed)
+        self.assertEqual(content, self.server.content)
+
+    def test_resume(self):
+        self.server.drop_after = 30000
+        changed, content = self.download()
+        self.assertTrue(changed)
+        self.assertEqual(content, self.server.content)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]['range'], 'bytes=30000-')
+        self.assertEqual(self.server.requests[1]['if-range'], '"v1"')
+        self.assertEqual(self.source.zip_sha256, hashlib.sha256(self.server.content).hexdigest())
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
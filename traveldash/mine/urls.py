@@ -10,6 +10,7 @@ urlpatterns = patterns('traveldash.mine.views',
 
     url(r'^(?P<pk>\d+)/$', 'dashboard'),
     url(r'^(?P<pk>\d+)/data/$', 'dashboard_update'),
+    url(r'^(?P<pk>\d+)/events/$', 'dashboard_stream'),
     url(r'^(?P<pk>\d+)/edit/$', 'dashboard_edit'),
     url(r'^(?P<pk>\d+)/edit/delete/$', DashboardDelete.as_view(), name="dashboard-delete"),
 )
@@ -1,6 +1,6 @@
 import json
 
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
 from django.template.response import TemplateResponse
 from django.views.decorators.cache import cache_control
 from django.views.decorators.vary import vary_on_cookie
@@ -11,12 +11,14 @@ from django.contrib import messages
 from django import forms
 from django.forms.models import inlineformset_factory
 from django.core.urlresolvers import reverse
+from django.utils.http import parse_etags, quote_etag
 from django.conf import settings
 from django.contrib.gis.utils import GeoIP
 
 from bootstrap.forms import BootstrapModelForm
 
 from traveldash.mine.models import Dashboard, DashboardRoute, City
+from traveldash.mine.cache import dashboard_json, dashboard_events, example_dashboard_id
 from traveldash.gtfs.models import Route, Stop
 
 
@@ -40,8 +42,11 @@ def home(request):
                     pass
             return HttpResponseRedirect(redirect)
 
-    example_dashboard = Dashboard.objects.exclude(routes__isnull=True).order_by('?')[0]
-    return TemplateResponse(request, "mine/home.html", {'example_dashboard': example_dashboard})
+    example_dashboard_url = None
+    example_pk = example_dashboard_id()
+    if example_pk is not None:
+        example_dashboard_url = reverse('traveldash.mine.views.dashboard', args=[str(example_pk)])
+    return TemplateResponse(request, "mine/home.html", {'example_dashboard_url': example_dashboard_url})
 
 
 @vary_on_cookie
@@ -70,8 +75,26 @@ def dashboard_update(request, pk):
     except Dashboard.DoesNotExist:
         return HttpResponse(json.dumps({"error": "dashboard-not-found"}), status=404, content_type="application/json")
 
-    content = dashboard.as_json()
-    return HttpResponse(json.dumps(content), content_type="application/json")
+    # clients send back the ETag, so unchanged polls get an empty 304
+    etag, content = dashboard_json(dashboard)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type="application/json")
+    response['ETag'] = quote_etag(etag)
+    return response
+
+
+@cache_control(no_cache=True)
+def dashboard_stream(request, pk):
+    """ Server-Sent Events version of dashboard_update, see cache.dashboard_events() """
+    try:
+        dashboard = Dashboard.objects.get(pk=pk)
+    except Dashboard.DoesNotExist:
+        raise Http404
+
+    content = dashboard_events(dashboard, request.META.get('HTTP_LAST_EVENT_ID'))
+    return HttpResponse(content, content_type="text/event-stream")
 
 
 @login_required
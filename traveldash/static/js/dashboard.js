@@ -2,6 +2,8 @@
 (function() {
     window.td = {
         warning_time: 0,
+        routes: {},
+        events: null,
 
         formatDateUntil : function(date) {
             var delta = -date.getElapsed();
@@ -71,26 +73,70 @@
         },
         
         update: function() {
-            $.getJSON('data/', function(data) {
-                td.warning_time = data.warning_time;
-
-                var valid_ids = [];
-                $.each(data.departures, function(i, dep) {
-                    var id = "td_trip_" + dep.trip.id;
-                    if (!$("#" + id).length) {
-                        var route = data.routes[dep.route];
-                        td.schedule.append(td.makerow(dep, route));
-                    }
-                    valid_ids.push(id);
-                });
-                $("tr", td.schedule)
-                    .filter(function(i) {
-                        return (valid_ids.indexOf(this.id) < 0);
-                    })
-                    .remove();
-                $("#empty").toggle($("tr", td.schedule).length === 0);
+            // ifModified sends the last ETag back, and we get an empty
+            // 'notmodified' response if nothing's changed
+            $.ajax({
+                url: 'data/',
+                dataType: 'json',
+                ifModified: true,
+                success: td.updateData
+            });
+        },
+
+        updateData: function(data, status) {
+            if (status === 'notmodified' || !data) {
                 td.refreshTimes();
+                return;
+            }
+            td.warning_time = data.warning_time;
+            td.routes = data.routes;
+
+            var valid_ids = [];
+            $.each(data.departures, function(i, dep) {
+                var id = "td_trip_" + dep.trip.id;
+                if (!$("#" + id).length) {
+                    var route = data.routes[dep.route];
+                    td.schedule.append(td.makerow(dep, route));
+                }
+                valid_ids.push(id);
             });
+            $("tr", td.schedule)
+                .filter(function(i) {
+                    return (valid_ids.indexOf(this.id) < 0);
+                })
+                .remove();
+            $("#empty").toggle($("tr", td.schedule).length === 0);
+            td.refreshTimes();
+        },
+
+        stream: function() {
+            // the server sends a 'snapshot' of everything when we connect,
+            // then 'delta' events with the departures added & removed since
+            td.events = new EventSource('events/');
+            td.events.addEventListener('snapshot', function(e) {
+                td.updateData(JSON.parse(e.data));
+            }, false);
+            td.events.addEventListener('delta', function(e) {
+                td.applyDelta(JSON.parse(e.data));
+            }, false);
+        },
+
+        applyDelta: function(delta) {
+            td.warning_time = delta.warning_time;
+            if (delta.routes) {
+                td.routes = delta.routes;
+            }
+
+            $.each(delta.removed, function(i, trip_id) {
+                $("#td_trip_" + trip_id).remove();
+            });
+            $.each(delta.added, function(i, dep) {
+                if (!$("#td_trip_" + dep.trip.id).length) {
+                    td.schedule.append(td.makerow(dep, td.routes[dep.route]));
+                }
+            });
+            $("#empty").toggle($("tr", td.schedule).length === 0);
+            td.refreshTimes();
         },
 
         refreshTimes : function() {
@@ -162,14 +208,19 @@
 
         // onload
         td.schedule = $("#schedule");
-        td.update();
-
-        window.setInterval(td.update, UPDATE*1000);
+        if (window.EventSource) {
+            td.stream();
+        } else {
+            td.update();
+            window.setInterval(td.update, UPDATE*1000);
+        }
         window.setInterval(td.refreshTimes, REFRESH*1000);
 
         window.addEventListener('focus', function() {
             td.refreshTimes();
-            td.update();
+            if (!td.events) {
+                td.update();
+            }
         });
     });
 })();